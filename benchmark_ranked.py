@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Benchmarks the RankedModel rank engine using the test models. Each
+# operation is timed and its queries counted at a range of list sizes and
+# group counts on tests.Wide, whose rank column holds more than 32,767 rows.
+# Results are written as JSON so runs can be compared against a baseline:
+#
+#   ./benchmark_ranked.py --sizes 1000 10000 --output baseline.json
+#
+import argparse
+import json
+import string
+import sys
+import time
+
+import django
+
+from boot_django import boot_django
+
+# call the django setup routine
+boot_django()
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from tests.models import Wide
+
+# ============================================================================
+
+def seed(klass, rows, groups):
+    # fills the table with "rows" objects spread evenly across "groups"
+    # groups, bypassing save() so that seeding isn't what gets measured
+    klass.objects.all()._raw_delete(klass.objects.db)
+    names = string.ascii_letters[:groups]
+    objs = []
+    for count in range(rows):
+        objs.append(klass(name='x', rank=count // groups + 1, 
+            group=names[count % groups]))
+
+    klass.objects.bulk_create(objs, batch_size=5000)
+
+
+def first_group(klass):
+    return klass.objects.filter(group='a')
+
+
+def create_kwargs(klass):
+    return {'name':'n', 'group':'a'}
+
+# ----------------------------------------------------------------------------
+# Operations: each takes the model class, does any setup and returns a
+# callable that makes the change being measured
+
+def insert_end(klass):
+    kwargs = create_kwargs(klass)
+    return lambda: klass.objects.create(**kwargs)
+
+
+def insert_top(klass):
+    kwargs = create_kwargs(klass)
+    return lambda: klass.objects.create(rank=1, **kwargs)
+
+
+def move_bottom_to_top(klass):
+    obj = first_group(klass).order_by('-rank').first()
+    def run():
+        obj.rank = 1
+        obj.save()
+
+    return run
+
+
+def move_to_top(klass):
+    obj = first_group(klass).order_by('-rank').first()
+    return obj.move_to_top
+
+
+def swap_ends(klass):
+    first = first_group(klass).order_by('rank').first()
+    last = first_group(klass).order_by('-rank').first()
+    return lambda: first.swap(last)
+
+
+def delete_top(klass):
+    obj = first_group(klass).order_by('rank').first()
+    return obj.delete
+
+
+def queryset_delete(klass):
+    # deletes the top ten of every group
+    return lambda: klass.objects.filter(rank__lte=10).delete()
+
+
+def repack(klass):
+    # open up a gap at the top of the group first
+    obj = first_group(klass).order_by('rank').first()
+    klass.objects.filter(id=obj.id)._raw_delete(klass.objects.db)
+    return obj.repack
+
+
+def batch_reverse_100(klass):
+    objs = list(first_group(klass).order_by('rank')[:100])
+    def run():
+        with klass.batch():
+            for rank, obj in enumerate(reversed(objs), start=1):
+                obj.move_to(rank)
+
+    return run
+
+
+OPERATIONS = [insert_end, insert_top, move_bottom_to_top, move_to_top,
+    swap_ends, delete_top, queryset_delete, repack, batch_reverse_100]
+
+# ============================================================================
+
+def measure(klass, rows, groups, operation, repeat):
+    best = None
+    for attempt in range(repeat):
+        seed(klass, rows, groups)
+        run = operation(klass)
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            with transaction.atomic():
+                run()
+            elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {
+        'model':klass._meta.label,
+        'rows':rows,
+        'groups':groups,
+        'operation':operation.__name__,
+        'seconds':round(best, 6),
+        'queries':len(context.captured_queries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Benchmarks RankedModel '
+        'operations and writes the results as JSON'))
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[1000, 10000, 100000], help='number of rows in the table')
+    parser.add_argument('--groups', type=int, nargs='+', default=[1, 10],
+        help='number of groups the rows are spread across (max 52)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per measurement, the fastest is kept')
+    parser.add_argument('--output', type=str, default='',
+        help='file to write the JSON to, defaults to stdout')
+    args = parser.parse_args()
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = []
+        for groups in args.groups:
+            for rows in args.sizes:
+                for operation in OPERATIONS:
+                    result = measure(Wide, rows, groups, operation,
+                        args.repeat)
+                    results.append(result)
+                    print('%(model)s rows=%(rows)s groups=%(groups)s '
+                        '%(operation)s: %(seconds)ss %(queries)s queries' %
+                        result, file=sys.stderr)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = {
+        'django':django.get_version(),
+        'database':connection.vendor,
+        'results':results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# awl.management.commands.audit_ranks.py
+#
+# Finds duplicate, missing and out of range ranks in RankedModel groups and
+# optionally repairs them.
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+
+from awl.rankedmodel.models import RankedModel
+
+# ===========================================================================
+
+class Command(BaseCommand):
+    """Audits the ranks of every concrete RankedModel, or of the models
+    given as "app_label.ModelName" arguments.  Each group is checked with
+    aggregate queries for duplicate ranks, gaps and ranks less than one, and
+    the broken groups are reported.  Nothing is changed unless "--repair" is
+    given, in which case each broken group is repacked with a bulk update,
+    committing "--chunk-size" groups at a time.
+
+    Models that override grouped_filter() without declaring
+    rank_group_fields can't be grouped by the database and are skipped.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.help = self.__doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', type=str,
+            help='labels of the models to audit, defaults to all of them')
+        parser.add_argument('--repair', action='store_true',
+            help='repack the broken groups instead of only reporting them')
+        parser.add_argument('--chunk-size', type=int, default=100,
+            help='number of groups repaired per transaction')
+
+    def _ranked_models(self, labels):
+        if not labels:
+            return [model for model in apps.get_models() if issubclass(
+                model, RankedModel) and not model._meta.proxy]
+
+        models = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CommandError('No such model: %s' % label)
+
+            if not issubclass(model, RankedModel):
+                raise CommandError('Not a RankedModel: %s' % label)
+
+            models.append(model)
+
+        return models
+
+    def _broken_groups(self, model):
+        # yields (group values, stats) for each group whose ranks aren't a
+        # run from 1 to the number of objects in the group
+        names = model.rank_group_fields
+        aggregates = {
+            'total':Count('pk'),
+            'low':Min('rank'),
+            'high':Max('rank'),
+            'distinct':Count('rank', distinct=True),
+        }
+
+        if not names:
+            # a single group
+            row = model._default_manager.aggregate(**aggregates)
+            if row['total'] and (row['low'] < 1 or 
+                    row['high'] != row['total'] or 
+                    row['distinct'] != row['total']):
+                yield {}, row
+
+            return
+
+        stats = model._default_manager.values(*names).annotate(
+            **aggregates).filter(Q(low__lt=1) | ~Q(high=F('total')) | 
+            ~Q(distinct=F('total'))).order_by(*names)
+
+        # the broken groups are read up front so that repairs don't change
+        # the results underneath an open cursor
+        for row in list(stats):
+            values = {model._meta.get_field(name).attname:row[name]
+                for name in names}
+            yield values, row
+
+    def _repair(self, model, chunk):
+        with transaction.atomic(using=model._default_manager.db):
+            for values in chunk:
+                # repack() on a stand-in object for the group locks it and
+                # writes the new ranks with a bulk update
+                model(**values).repack()
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+
+        for model in self._ranked_models(options['models']):
+            label = model._meta.label
+            if not model.rank_group_fields and \
+                    model.grouped_filter is not RankedModel.grouped_filter:
+                self.stdout.write('%s: skipped, grouped_filter() is '
+                    'overridden without rank_group_fields' % label)
+                continue
+
+            broken = 0
+            chunk = []
+            for values, row in self._broken_groups(model):
+                broken += 1
+                self.stdout.write(('%s %s: %s objects, ranks %s to %s, %s '
+                    'duplicates, %s missing') % (label, values, row['total'],
+                    row['low'], row['high'], row['total'] - row['distinct'],
+                    max(row['high'] - row['distinct'], 0)))
+
+                if options['repair']:
+                    chunk.append(values)
+                    if len(chunk) >= chunk_size:
+                        self._repair(model, chunk)
+                        chunk = []
+
+            if chunk:
+                self._repair(model, chunk)
+
+            if options['repair']:
+                self.stdout.write('%s: %s groups repaired' % (label, broken))
+            else:
+                self.stdout.write('%s: %s broken groups' % (label, broken))
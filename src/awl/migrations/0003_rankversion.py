@@ -0,0 +1,26 @@
+# Generated by Django 5.0 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0002_alter_counter_id_alter_lock_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('group', models.CharField(max_length=40)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rankversion',
+            constraint=models.UniqueConstraint(fields=('model', 'group'), name='awl_rankversion_unique'),
+        ),
+    ]
@@ -1,5 +1,18 @@
-from itertools import islice, chain
-from django.db import models, transaction
+import base64
+import heapq
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Value
+from django.db.models.query import (FlatValuesListIterable, ValuesIterable,
+    ValuesListIterable)
 
 from awl.absmodels import TimeTrackModel
 
@@ -54,6 +67,28 @@ class Lock(TimeTrackModel):
         """
         Lock.objects.select_for_update().get(name=name)
 
+
+class RankVersion(models.Model):
+    """Version number of a group of :class:`awl.rankedmodel.models.RankedModel`
+    objects, used by the model's optimistic concurrency mode.
+
+    :param model:
+        Label of the ranked model
+    :param group:
+        SHA1 hash of the group's key
+    :param version:
+        Incremented each time the ranks in the group change
+    """
+    model = models.CharField(max_length=100)
+    group = models.CharField(max_length=40)
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['model', 'group'], 
+                name='awl_rankversion_unique'),
+        ]
+
 # ============================================================================
 # Misc
 # ============================================================================
@@ -178,41 +213,1002 @@ class QuerySetChain:
     """
     Chains together multiple querysets (possibly of different models) and 
     behaves as one queryset.  Supports minimal methods needed for use with
-    django.core.paginator.  Does not support re-ordering or re-filtering
-    across the set.
+    django.core.paginator.  Does not support re-filtering across the set.
+
+    Subqueryset counts are cached on the chain and only done when needed,
+    so slicing the first pages (including fetching one extra record to see
+    if there is a next page) doesn't issue any ``COUNT`` queries.
 
     .. code-block:: python
 
         q1 = Thing.objects.filter(foo)
         q2 = Stuff.objects.filter(bar)
         qsc = QuerySetChain(q1, q2)
+
+    By default the records of each subqueryset follow those of the one
+    before it.  :class:`QuerySetChain.order_by` instead merges the
+    subquerysets on fields they have in common, see its documentation.
+    Either kind of chain can be paged with offsets through slicing, or with
+    :class:`QuerySetChain.cursor_page`.  Chains over slow or separate
+    databases can query their subquerysets concurrently, see
+    :class:`QuerySetChain.parallel`, and chains of ``values()`` querysets
+    can be run as a single query, see :class:`QuerySetChain.union_all`.
+    Very large chains can be counted with planner estimates, see
+    :class:`QuerySetChain.estimated`.
+
+    Related objects can be loaded for each model in the chain with
+    :class:`QuerySetChain.select_related` and
+    :class:`QuerySetChain.prefetch_related`.
+
+    Async views can use ``async for``, :class:`QuerySetChain.acount` and
+    :class:`QuerySetChain.agetitem`, which use Django's async queryset API
+    (Django 4.1 or later) for each subqueryset.
     """
+    #: Number of records read from each subqueryset at a time when iterating
+    #: a merged chain
+    merge_chunk_size = 100
 
     def __init__(self, *subquerysets):
         self.querysets = subquerysets
+        self.ordering = ()
+        self.max_workers = 0
+        self.union = False
+        self.estimate_threshold = None
+        self._counts = {}
+        self._union_count = None
+
+        #: True if the last call to ``count()`` used estimates
+        self.is_estimate = False
+
+    def estimated(self, threshold=10000):
+        """
+        Returns a copy of the chain whose ``count()`` uses the database's
+        planner estimates for large subquerysets instead of running exact
+        ``COUNT`` queries, which can take seconds on huge tables.  On
+        PostgreSQL an unfiltered subqueryset uses the table's
+        ``pg_class.reltuples``, a filtered one the row estimate from
+        ``EXPLAIN``.  Subquerysets estimated at less than ``threshold``
+        rows, and all subquerysets on other databases, are counted exactly.
+
+        ``is_estimate`` is set when a count used an estimate, so that a
+        paginated page can show "about N results"::
+
+            {% if page_obj.paginator.object_list.is_estimate %}about{% endif %}
+            {{ page_obj.paginator.count }} results
+
+        Estimates are only used for the total, slicing still uses exact
+        positions.  Pages near an over-estimated end of the chain come back
+        short or empty.
+
+        :param threshold:
+            Estimated number of rows at which a subqueryset's estimate is
+            used instead of counting it.  Defaults to 10000
+        """
+        clone = self._clone()
+        clone.estimate_threshold = threshold
+        return clone
+
+    def select_related(self, specs):
+        """
+        Returns a copy of the chain with ``select_related`` applied to the
+        subquerysets of each model given, so a template rendering a chain of
+        different models doesn't run a query per related object.
+
+        .. code-block:: python
+
+            chain = QuerySetChain(Book.objects.all(), Chapter.objects.all())
+            chain = chain.select_related({
+                Book:['author'],
+                'library.Chapter':['book__author'],
+            })
+
+        :param specs:
+            Dict mapping a model class or "app_label.ModelName" label to the
+            list of lookups for its subquerysets
+        :raises ValueError:
+            If a model isn't in the chain
+        """
+        return self._per_model('select_related', specs)
+
+    def prefetch_related(self, specs):
+        """
+        Returns a copy of the chain with ``prefetch_related`` applied to the
+        subquerysets of each model given, see
+        :class:`QuerySetChain.select_related` for the format of ``specs``.
+        Lookups can be strings or ``Prefetch`` objects.  The prefetching is
+        done for each slice of a subqueryset that is fetched, so the related
+        objects for a page are loaded in one query per lookup.
+
+        :param specs:
+            Dict mapping a model class or "app_label.ModelName" label to the
+            list of lookups for its subquerysets
+        :raises ValueError:
+            If a model isn't in the chain
+        """
+        return self._per_model('prefetch_related', specs)
+
+    def _per_model(self, method, specs):
+        # calls the named queryset method with each model's lookups on the
+        # subquerysets of that model
+        lookups = {}
+        for model, fields in specs.items():
+            if isinstance(model, str):
+                label = model.lower()
+            else:
+                label = model._meta.label_lower
+
+            if not any(qs.model._meta.label_lower == label for qs in 
+                    self.querysets):
+                raise ValueError('No subqueryset of model %s in chain' % (
+                    model))
+
+            lookups[label] = fields
+
+        clone = self._clone()
+        clone.querysets = tuple(
+            getattr(qs, method)(*lookups[qs.model._meta.label_lower])
+            if qs.model._meta.label_lower in lookups else qs 
+            for qs in self.querysets)
+        return clone
+
+    def union_all(self):
+        """
+        Returns a copy of the chain that, when possible, is run as a single
+        ``UNION ALL`` query of its subquerysets.  Counting is then one
+        ``COUNT`` query and a slice is one query with the ``ORDER BY`` and
+        ``LIMIT/OFFSET`` done by the database.
+
+        .. code-block:: python
+
+            feed = QuerySetChain(
+                Post.objects.values('title', 'created'),
+                Comment.objects.values('title', 'created'),
+            ).order_by('-created').union_all()
+
+        The union is only used if every subqueryset is a ``values()`` or
+        (non-flat) ``values_list()`` queryset on the same database, they
+        project the same number of columns and none of them are sliced.
+        The columns take their names from the first subqueryset.  A merged
+        chain's :class:`QuerySetChain.order_by` fields must be amongst
+        those columns.  A chain that isn't merged can only use the union if
+        none of its subquerysets are ordered (call ``order_by()`` with no
+        arguments to clear any default ordering), chain order is kept by
+        ordering on an extra column that is removed from the results and
+        the records of each subqueryset come back ordered by their columns.
+        Either way ties are broken on the remaining columns so that pages
+        don't repeat or skip records.
+
+        Chains that can't be run as a union behave as usual.
+        """
+        clone = self._clone()
+        clone.union = True
+        return clone
+
+    def _union_queryset(self):
+        # the chain as a single UNION ALL queryset, or None if it isn't
+        # possible
+        if not self.union or not self.querysets:
+            return None
+
+        first = self.querysets[0]
+        width = _values_width(first)
+        names = list(first.query.values_select) + list(
+            first.query.annotation_select)
+        for field in self.ordering:
+            if field.lstrip('-') not in names:
+                return None
+
+        members = []
+        for position, qs in enumerate(self.querysets):
+            if qs._iterable_class not in (ValuesIterable, 
+                    ValuesListIterable) or \
+                    qs._iterable_class is not first._iterable_class or \
+                    qs.db != first.db or qs.query.is_sliced or \
+                    qs.query.combinator or _values_width(qs) != width:
+                return None
+
+            if self.ordering:
+                qs = qs.order_by()
+            elif qs.ordered:
+                return None
+            else:
+                qs = qs.annotate(**{_CHAIN_POSITION:Value(position)})
+
+            members.append(qs)
+
+        # the remaining columns break ties so that LIMIT/OFFSET pages are
+        # stable
+        combined = members[0].union(*members[1:], all=True)
+        keys = [field.lstrip('-') for field in self.ordering]
+        ties = [name for name in names if name not in keys]
+        if self.ordering:
+            return combined.order_by(*_null_ordering(self.ordering), *ties)
+
+        return combined.order_by(_CHAIN_POSITION, *ties)
+
+    def _union_records(self, records, iterable_class):
+        # removes the extra position column from the results of a union
+        for record in records:
+            if self.ordering:
+                yield record
+            elif iterable_class is ValuesIterable:
+                del record[_CHAIN_POSITION]
+                yield record
+            else:
+                yield record[:-1]
+
+    def parallel(self, max_workers=4):
+        """
+        Returns a copy of the chain that runs the queries for its
+        subquerysets concurrently on a pool of at most ``max_workers``
+        threads, so a slice or count takes as long as the slowest
+        subqueryset instead of the sum of them.  Results still come back in
+        chain order.
+
+        A slice counts the uncounted subquerysets at once and then fetches
+        the parts of the slice from each at once, a merged slice fetches
+        from every subqueryset at once.  Each thread uses its own database
+        connections, which are closed when its query is done, so the
+        subquerysets only see committed data.
+
+        :param max_workers:
+            Maximum number of threads, less than 2 turns concurrency off.
+            Defaults to 4
+        """
+        clone = self._clone()
+        clone.max_workers = max_workers
+        return clone
+
+    def _map(self, function, items):
+        # calls function on each item, concurrently if the chain is
+        # parallel, returning the results in order
+        items = list(items)
+        if self.max_workers < 2 or len(items) < 2:
+            return [function(item) for item in items]
+
+        workers = min(self.max_workers, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(partial(_in_thread, function), items))
+
+    def order_by(self, *fields):
+        """
+        Returns a copy of the chain that merges its subquerysets in the
+        order of the given fields, as if they were a single ordered
+        queryset.  Each subqueryset is ordered by the fields and the records
+        are merged with a heap, reading only as many records from each
+        subqueryset as the slice being fetched needs: the first page of a
+        merged feed costs at most a page of records per subqueryset.
+
+        .. code-block:: python
+
+            feed = QuerySetChain(Post.objects.all(), 
+                Comment.objects.all()).order_by('-created', 'id')
+            page = feed[:20]
+
+        Fields use the same syntax as ``QuerySet.order_by``, including a
+        leading "-" for descending order and "__" to span relations (which
+        are followed in Python, consider ``select_related``).  Nulls sort
+        before any other value, the subquerysets are ordered with explicit
+        ``NULLS FIRST``/``NULLS LAST`` so every database agrees.  Records
+        with equal keys come out in subqueryset order.  ``values()`` and
+        ``values_list()`` subquerysets must include the fields in their
+        values.
+
+        :param fields:
+            Names of the fields to order by, all subquerysets need them
+        :raises ValueError:
+            If a ``values()`` or ``values_list()`` subqueryset doesn't
+            include one of the fields
+        """
+        for qs in self.querysets:
+            _check_values(qs, fields)
+
+        clone = self._clone()
+        clone.ordering = fields
+        clone.querysets = tuple(qs.order_by(*_null_ordering(fields)) for qs 
+            in self.querysets)
+        return clone
 
     def count(self):
         """
-        Performs a .count() for all subquerysets and returns the number of
-        records as an integer.
+        Returns the number of records in all the subquerysets as an integer.
+        Each subqueryset is counted at most once per chain, and not at all if
+        slicing has already found where it ends.
         """
-        return sum(qs.count() for qs in self.querysets)
+        if self.estimate_threshold is not None:
+            return self._estimated_count()
+
+        combined = self._union_queryset()
+        if combined is not None:
+            if self._union_count is None:
+                self._union_count = combined.count()
+
+            return self._union_count
+
+        self._count_all()
+        return sum(self._count(position) for position in range(len(
+            self.querysets)))
+
+    def __len__(self):
+        return self.count()
+
+    def _count(self, position):
+        # count of the subqueryset at the given position, cached so that
+        # repeated slicing doesn't re-count
+        if position not in self._counts:
+            self._counts[position] = self.querysets[position].count()
+
+        return self._counts[position]
+
+    def _estimated_count(self):
+        # count using estimates for the subquerysets that aren't counted
+        # and are estimated above the threshold
+        total = 0
+        self.is_estimate = False
+        for position, qs in enumerate(self.querysets):
+            if position in self._counts:
+                total += self._counts[position]
+                continue
+
+            estimate = _estimated_count(qs)
+            if estimate is None or estimate < self.estimate_threshold:
+                total += self._count(position)
+            else:
+                total += estimate
+                self.is_estimate = True
+
+        return total
+
+    def _count_all(self):
+        # counts every uncounted subqueryset at once in a parallel chain
+        if self.max_workers < 2:
+            return
+
+        missing = [position for position in range(len(self.querysets)) if
+            position not in self._counts]
+        counts = self._map(lambda position: self.querysets[position].count(),
+            missing)
+        self._counts.update(zip(missing, counts))
 
     def _clone(self):
         "Returns a clone of this queryset chain"
-        return self.__class__(*self.querysets)
+        clone = self.__class__(*self.querysets)
+        clone.ordering = self.ordering
+        clone.max_workers = self.max_workers
+        clone.union = self.union
+        clone.estimate_threshold = self.estimate_threshold
+        return clone
 
     def _all(self):
         "Iterates records in all subquerysets"
+        combined = self._union_queryset()
+        if combined is not None:
+            return self._union_records(combined, combined._iterable_class)
+
+        if self.ordering:
+            return self._merged(self.merge_chunk_size)
+
         return chain(*self.querysets)
 
+    def _merge(self, sources, fields=None):
+        # merges the ordered records read from each subqueryset, sources
+        # being in chain order, yielding (position, record) pairs
+        keyed = [_keyed(fields or self.ordering, qs, position, records) 
+            for position, (qs, records) in enumerate(zip(self.querysets, 
+            sources))]
+        for key, position, record in heapq.merge(*keyed, key=itemgetter(0)):
+            yield position, record
+
+    def _merge_plan(self, chunk_size):
+        # The merge behind _merged() and _amerged(), reading each ordered
+        # subqueryset chunk_size records at a time and keeping a heap of
+        # the next record from each.  A generator that yields (queryset,
+        # None) when a chunk needs reading, and is sent its records, and
+        # (None, record) for each record in merged order
+        columns = [_columns(qs) for qs in self.querysets]
+        offsets = [0] * len(self.querysets)
+        buffers = [deque() for qs in self.querysets]
+        ended = [False] * len(self.querysets)
+        end = object()
+
+        def pull(position):
+            # next record of a subqueryset, end once it is exhausted
+            if not buffers[position] and not ended[position]:
+                offset = offsets[position]
+                records = yield (self.querysets[position][offset:offset +
+                    chunk_size], None)
+                offsets[position] += chunk_size
+                ended[position] = len(records) < chunk_size
+                buffers[position].extend(records)
+
+            if buffers[position]:
+                return buffers[position].popleft()
+
+            return end
+
+        heap = []
+        for position in range(len(self.querysets)):
+            record = yield from pull(position)
+            if record is not end:
+                heap.append((_MergeKey(self.ordering, record,
+                    columns[position]), position, record))
+
+        heapq.heapify(heap)
+        while heap:
+            key, position, record = heap[0]
+            yield None, record
+
+            record = yield from pull(position)
+            if record is end:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (_MergeKey(self.ordering, record,
+                    columns[position]), position, record))
+
+    def _merged(self, chunk_size):
+        # merges the ordered subquerysets, each read chunk_size records at a
+        # time
+        plan = self._merge_plan(chunk_size)
+        records = None
+        while True:
+            try:
+                request, record = plan.send(records)
+            except StopIteration:
+                return
+
+            records = None
+            if request is None:
+                yield record
+            else:
+                records = self._read(request)
+
+    def iterator(self, chunk_size=2000):
+        """
+        Streams the records of the chain without caching them, for exports
+        and ``StreamingHttpResponse``.  Each subqueryset is read with
+        ``QuerySet.iterator``, using a server-side cursor on databases that
+        support them, so memory use stays flat however large the chain is.
+        Subquerysets are streamed one after another, or all at once and
+        merged for a :class:`QuerySetChain.order_by` chain, or as the single
+        query of a :class:`QuerySetChain.union_all` chain.
+
+        .. code-block:: python
+
+            def rows():
+                for record in chain.iterator():
+                    yield '%s\\n' % record
+
+            return StreamingHttpResponse(rows(), content_type='text/plain')
+
+        :param chunk_size:
+            Number of records fetched from the database at a time.
+            Defaults to 2000
+        :returns:
+            Generator of records
+        """
+        combined = self._union_queryset()
+        if combined is not None:
+            yield from self._union_records(combined.iterator(
+                chunk_size=chunk_size), combined._iterable_class)
+        elif self.ordering:
+            for position, record in self._merge([qs.iterator(
+                    chunk_size=chunk_size) for qs in self.querysets]):
+                yield record
+        else:
+            for qs in self.querysets:
+                yield from qs.iterator(chunk_size=chunk_size)
+
+    def _slice_plan(self, start, stop):
+        # Plans reading the records from start up to stop (None for the end
+        # of the chain), see _run_plan() for how a plan runs.  The
+        # subqueryset counts are used to skip over the subquerysets before
+        # the slice, and only those the slice covers are queried, each with
+        # a LIMIT/OFFSET.  Counts are lazy: a subqueryset is sliced first,
+        # returning fewer records than asked for gives its count for free,
+        # it is only counted when the slice starts past its end
+        if self.max_workers > 1:
+            # parallel chains count everything first, then fetch the part
+            # of the slice each subqueryset covers at once
+            yield tuple(position for position in range(len(self.querysets))
+                if position not in self._counts)
+
+            parts = []
+            for position, qs in enumerate(self.querysets):
+                count = self._counts[position]
+                end = count if stop is None else min(stop, count)
+                if start < end:
+                    parts.append(qs[start:end])
+
+                start = max(start - count, 0)
+                if stop is not None:
+                    stop -= count
+
+            return list(chain(*(yield tuple(parts))))
+
+        results = []
+        for position, qs in enumerate(self.querysets):
+            if stop is not None and stop <= 0:
+                break
+
+            count = self._counts.get(position)
+            if count is None:
+                records = yield qs[start:stop]
+                if not records and start > 0:
+                    count = yield position
+                elif stop is not None and len(records) == stop - start:
+                    # slice is full, what follows isn't needed
+                    results.extend(records)
+                    break
+                else:
+                    count = self._counts[position] = start + len(records)
+                    results.extend(records)
+            elif start < count:
+                end = count if stop is None else min(stop, count)
+                results.extend((yield qs[start:end]))
+
+            start = max(start - count, 0)
+            if stop is not None:
+                stop -= count
+
+        return results
+
+    def _index_plan(self, index):
+        # plans chain[index] for both __getitem__() and agetitem()
+        if type(index) is not slice:
+            if index < 0:
+                raise ValueError('Negative indexing is not supported.')
+
+            results = yield from self._index_plan(slice(index, index + 1))
+            if not results:
+                raise IndexError('QuerySetChain index out of range')
+
+            return results[0]
+
+        start = index.start or 0
+        if start < 0 or (index.stop is not None and index.stop < 0):
+            raise ValueError('Negative indexing is not supported.')
+
+        combined = self._union_queryset()
+        if combined is not None:
+            records = yield combined[start:index.stop]
+            results = list(self._union_records(records, 
+                combined._iterable_class))
+        elif self.ordering:
+            # every subqueryset could provide the whole slice
+            sources = yield tuple(qs[:index.stop] for qs in self.querysets)
+            results = [record for position, record in islice(
+                self._merge(sources), start, index.stop)]
+        else:
+            results = yield from self._slice_plan(start, index.stop)
+
+        if index.step:
+            results = results[::index.step]
+
+        return results
+
+    def _read(self, request):
+        # does a read asked for by a plan: a subqueryset position gives its
+        # count, a tuple of requests gives their results (read concurrently
+        # if the chain is parallel) and a sliced queryset gives its records
+        if isinstance(request, int):
+            return self._count(request)
+
+        if isinstance(request, tuple):
+            return self._map(self._read, request)
+
+        return list(request)
+
+    def _run_plan(self, plan):
+        # A plan is a generator shared by the sync and async APIs, it
+        # yields the reads it needs, is sent the result of each and returns
+        # its answer.  This runs one synchronously
+        result = None
+        while True:
+            try:
+                request = plan.send(result)
+            except StopIteration as done:
+                return done.value
+
+            result = self._read(request)
+
     def __getitem__(self, index):
         """
         Retrieves an item or slice from the chained set of results from all
-        subquerysets.
+        subquerysets.  Only the subquerysets that the slice covers are
+        queried.
+        """
+        return self._run_plan(self._index_plan(index))
+
+    # --- Async API
+    async def acount(self):
+        """
+        Async version of :class:`QuerySetChain.count`, counting each
+        subqueryset with ``QuerySet.acount``.  Estimated counts need a
+        synchronous cursor and are run with ``sync_to_async``.
+        """
+        if self.estimate_threshold is not None:
+            return await sync_to_async(self.count)()
+
+        combined = self._union_queryset()
+        if combined is not None:
+            if self._union_count is None:
+                self._union_count = await combined.acount()
+
+            return self._union_count
+
+        total = 0
+        for position in range(len(self.querysets)):
+            total += await self._acount(position)
+
+        return total
+
+    async def _acount(self, position):
+        if position not in self._counts:
+            self._counts[position] = await self.querysets[position].acount()
+
+        return self._counts[position]
+
+    async def _aread(self, request):
+        # async version of _read()
+        if isinstance(request, int):
+            return await self._acount(request)
+
+        if isinstance(request, tuple):
+            return [await self._aread(item) for item in request]
+
+        return await _alist(request)
+
+    async def _arun_plan(self, plan):
+        # runs a plan (see _run_plan()) asynchronously
+        result = None
+        while True:
+            try:
+                request = plan.send(result)
+            except StopIteration as done:
+                return done.value
+
+            result = await self._aread(request)
+
+    async def agetitem(self, index):
         """
-        if type(index) is slice:
-            return list(islice(self._all(), index.start, index.stop, 
-                index.step or 1))
+        Async version of ``chain[index]``, takes an integer or a
+        ``slice``.
+
+        .. code-block:: python
+
+            records = await chain.agetitem(slice(20, 40))
+        """
+        return await self._arun_plan(self._index_plan(index))
+
+    async def _astream(self, qs, chunk_size):
+        # reads the records of a subqueryset a slice at a time
+        offset = 0
+        while True:
+            records = await _alist(qs[offset:offset + chunk_size])
+            for record in records:
+                yield record
+
+            if len(records) < chunk_size:
+                return
+
+            offset += chunk_size
+
+    async def _amerged(self):
+        # async version of _merged()
+        plan = self._merge_plan(self.merge_chunk_size)
+        records = None
+        while True:
+            try:
+                request, record = plan.send(records)
+            except StopIteration:
+                return
+
+            records = None
+            if request is None:
+                yield record
+            else:
+                records = await self._aread(request)
+
+    async def __aiter__(self):
+        combined = self._union_queryset()
+        if combined is not None:
+            async for record in combined.aiterator():
+                for result in self._union_records([record], 
+                        combined._iterable_class):
+                    yield result
+        elif self.ordering:
+            async for record in self._amerged():
+                yield record
         else:
-            return next(islice(self._all(), index, index+1))
+            for qs in self.querysets:
+                if qs._prefetch_related_lookups:
+                    # aiterator() refuses prefetch_related() before Django
+                    # 5.0 and then needs a chunk_size, slicing works on all
+                    records = self._astream(qs, self.merge_chunk_size)
+                else:
+                    records = qs.aiterator()
+
+                async for record in records:
+                    yield record
+
+    def cursor_page(self, cursor=None, size=20, fields=('pk', )):
+        """
+        Keyset (cursor) pagination.  Returns a page of records along with an
+        opaque cursor string for the page after it.  The cursor holds the
+        position of the subqueryset the page ended in and the ordering key
+        of its last record, the next page is fetched with ``WHERE key >
+        cursor`` queries on each subqueryset that isn't finished, which are
+        served by an index on the key.  No ``COUNT`` queries are made, deep
+        pages cost the same as the first one, and records inserted or
+        deleted elsewhere in the chain don't shift the pages.
+
+        .. code-block:: python
+
+            records, cursor = chain.cursor_page(size=50)
+            more, cursor = chain.cursor_page(cursor, size=50)
+
+        Records are ordered by the chain's :class:`QuerySetChain.order_by`
+        fields if it is merged, otherwise each subqueryset is ordered by
+        ``fields``.  The key must be unique within each subqueryset (end it
+        with ``pk`` or ``id``), none of its values may be null, and for
+        ``values()`` querysets it must be amongst the values.
+
+        :param cursor:
+            Cursor returned with the previous page, None for the first page
+        :param size:
+            Number of records in the page.  Defaults to 20
+        :param fields:
+            Ordering key for a chain that isn't merged.  Defaults to
+            ``('pk', )``
+        :returns:
+            Tuple (list of records, cursor for the next page or None if this
+            is the last page)
+        :raises ValueError:
+            If the cursor can't be decoded, or doesn't fit this chain
+        """
+        if self.ordering:
+            fields = self.ordering
+
+        position, values = 0, None
+        if cursor is not None:
+            try:
+                position, values = json.loads(base64.urlsafe_b64decode(
+                    cursor.encode('ascii')))
+                if isinstance(position, bool) or \
+                        not isinstance(position, int) or \
+                        not 0 <= position < len(self.querysets) or \
+                        not isinstance(values, list) or \
+                        len(values) != len(fields):
+                    raise ValueError('Cursor is for a different chain')
+            except (TypeError, ValueError, UnicodeError) as error:
+                raise ValueError('Bad cursor %r' % cursor) from error
+
+        # one extra record is read to find out if there is a next page
+        wanted = size + 1
+        if self.ordering:
+            sources = []
+            for index, qs in enumerate(self.querysets):
+                if values is not None:
+                    # records with equal keys are done for the subquerysets
+                    # up to and including the cursor's
+                    qs = qs.filter(_after_q(fields, values, 
+                        inclusive=index > position))
+
+                sources.append(qs[:wanted])
+
+            found = [(record, index) for index, record in islice(
+                self._merge(self._map(list, sources)), wanted)]
+        else:
+            found = []
+            for index in range(position, len(self.querysets)):
+                _check_values(self.querysets[index], fields)
+                qs = self.querysets[index].order_by(*fields)
+                if values is not None and index == position:
+                    qs = qs.filter(_after_q(fields, values))
+
+                found.extend((record, index) for record in qs[:wanted - 
+                    len(found)])
+                if len(found) == wanted:
+                    break
+
+        records = [record for record, index in found[:size]]
+        if len(found) <= size:
+            return records, None
+
+        record, index = found[size - 1]
+        data = json.dumps([index, _record_values(record, fields, 
+            _columns(self.querysets[index]))], cls=DjangoJSONEncoder)
+        return records, base64.urlsafe_b64encode(data.encode('utf-8')).decode(
+            'ascii')
+
+
+# name of the column used to keep chain order in a UNION ALL query
+_CHAIN_POSITION = 'awl_chain_position'
+
+def _values_width(qs):
+    # number of columns projected by a values() queryset
+    return len(qs.query.values_select) + len(qs.query.annotation_select) + \
+        len(qs.query.extra_select)
+
+
+def _estimated_count(qs):
+    # the planner's estimate of the number of rows in a queryset, None if
+    # the database doesn't provide one
+    connection = connections[qs.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    query = qs.query
+    if not query.where and not query.distinct and not query.is_sliced and \
+            not query.combinator and not query.group_by:
+        # the whole table, its row estimate is kept by VACUUM and ANALYZE
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = '
+                '%s::regclass', [connection.ops.quote_name(
+                qs.model._meta.db_table)])
+            row = cursor.fetchone()
+
+        # reltuples is negative for a table that hasn't been analyzed
+        if row and row[0] >= 0:
+            return int(row[0])
+
+    # run directly rather than through explain(), which only gives JSON on
+    # Django 4.1 and later
+    sql, params = query.get_compiler(using=qs.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+
+    # psycopg decodes the json column, other drivers return the text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def _alist(records):
+    # evaluates a sliced queryset asynchronously, slicing a queryset whose
+    # results are already cached gives a list
+    if isinstance(records, list):
+        return records
+
+    return [record async for record in records]
+
+
+def _in_thread(function, item):
+    # runs in a QuerySetChain worker thread, which gets its own database
+    # connections that need closing once done
+    try:
+        return function(item)
+    finally:
+        connections.close_all()
+
+
+def _values_names(qs):
+    # names of the columns of a values() or values_list() queryset in the
+    # order they are returned, None for a queryset of model objects
+    if not issubclass(qs._iterable_class, (ValuesIterable, 
+            ValuesListIterable, FlatValuesListIterable)):
+        return None
+
+    query = qs.query
+    if qs._fields and qs._iterable_class is not ValuesIterable:
+        # values_list() returns the named columns in the order given
+        return [*qs._fields, *(name for name in query.annotation_select if
+            name not in qs._fields)]
+
+    return [*query.extra_select, *query.values_select, 
+        *query.annotation_select]
+
+
+def _check_values(qs, fields):
+    # ordering fields must be amongst the values of values() querysets
+    names = _values_names(qs)
+    if names is None:
+        return
+
+    for field in fields:
+        if field.lstrip('-') not in names:
+            raise ValueError('%s is not one of the values %s of %s' % (
+                field.lstrip('-'), names, qs.model._meta.label))
+
+
+def _columns(qs):
+    # maps the names of a values_list() queryset's columns to their
+    # position in its tuples, a flat queryset's one column maps to None as
+    # the record is its value.  None for other querysets
+    if issubclass(qs._iterable_class, FlatValuesListIterable):
+        return {_values_names(qs)[0]:None}
+
+    if issubclass(qs._iterable_class, ValuesListIterable):
+        return {name:position for position, name in enumerate(
+            _values_names(qs))}
+
+    return None
+
+
+def _null_ordering(fields):
+    # ordering expressions sorting nulls the way _MergeKey does: first when
+    # ascending, last when descending
+    return [F(field[1:]).desc(nulls_last=True) if field.startswith('-') 
+        else F(field).asc(nulls_first=True) for field in fields]
+
+
+def _keyed(fields, qs, position, records):
+    # (merge key, position, record) for each record of a subqueryset
+    columns = _columns(qs)
+    for record in records:
+        yield _MergeKey(fields, record, columns), position, record
+
+
+def _record_values(record, fields, columns=None):
+    # values of the ordering fields for a model object, values() record or,
+    # given its columns, values_list() record
+    values = []
+    for field in fields:
+        name = field.lstrip('-')
+        if columns is not None:
+            position = columns[name]
+            value = record if position is None else record[position]
+        elif isinstance(record, dict):
+            # values() records are keyed by the full lookup
+            value = record[name]
+        else:
+            value = record
+            for part in name.split('__'):
+                if value is None:
+                    break
+
+                value = getattr(value, part)
+
+        values.append(value)
+
+    return values
+
+
+def _after_q(fields, values, inclusive=False):
+    # Q matching the records ordered after the given key values, including
+    # the one equal to it if inclusive: (a > x) | (a = x & b > y) | ...
+    query = None
+    for count, field in enumerate(fields):
+        name = field.lstrip('-')
+        last = count == len(fields) - 1
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        if last and inclusive:
+            lookup += 'e'
+
+        term = Q(**{'%s__%s' % (name, lookup):values[count]})
+        for previous, value in zip(fields[:count], values):
+            term &= Q(**{previous.lstrip('-'):value})
+
+        query = term if query is None else query | term
+
+    return query
+
+
+class _MergeKey:
+    # Sort key for a record in a merged QuerySetChain, compares the values of
+    # the ordering fields honouring each field's direction
+
+    def __init__(self, ordering, record, columns=None):
+        self.values = [(field.startswith('-'), value) for field, value in 
+            zip(ordering, _record_values(record, ordering, columns))]
+
+    def __lt__(self, other):
+        for (descending, mine), (_, theirs) in zip(self.values, 
+                other.values):
+            if mine == theirs:
+                continue
+
+            if mine is None or theirs is None:
+                less = mine is None
+            else:
+                less = mine < theirs
+
+            return less != descending
+
+        return False
+
+    def __eq__(self, other):
+        # equal keys fall through to the next item when in a tuple
+        return self.values == other.values
@@ -1,7 +1,9 @@
 # awl.rankedmodel.admin.py
+import hashlib
+from functools import lru_cache
 
 from django.contrib.contenttypes.models import ContentType
-from django.urls import reverse
+from django.urls import get_script_prefix, get_urlconf, reverse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
@@ -9,6 +11,67 @@ from django.utils.safestring import mark_safe
 # RankedModel Helper Methods
 # =============================================================================
 
+@lru_cache(maxsize=None)
+def _move_url_prefix(content_type_id, urlconf, script_prefix):
+    # the move view's URL up to the object id, resolved once per content
+    # type instead of once per row
+    link = reverse('awl-rankedmodel-move', urlconf=urlconf, 
+        args=(content_type_id, 0, 0))
+    return link[:-len('0/0/')]
+
+
+def _move_url(obj, rank):
+    content_type = ContentType.objects.get_for_model(obj)
+    prefix = _move_url_prefix(content_type.id, get_urlconf(), 
+        get_script_prefix())
+    return '%s%s/%s/' % (prefix, obj.id, rank)
+
+
+@lru_cache(maxsize=None)
+def _reorder_url_cached(content_type_id, urlconf, script_prefix):
+    # the reorder view's URL, resolved once per content type
+    return reverse('awl-rankedmodel-reorder', urlconf=urlconf, 
+        args=(content_type_id, ))
+
+
+def _reorder_url(obj):
+    content_type = ContentType.objects.get_for_model(obj)
+    return _reorder_url_cached(content_type.id, get_urlconf(), 
+        get_script_prefix())
+
+
+def _group_max_rank(obj):
+    # uses the annotation from RankedModelAdminMixin when it is available
+    max_rank = getattr(obj, 'rank_group_max', None)
+    if max_rank is None:
+        max_rank = obj.grouped_filter().count()
+
+    return max_rank
+
+
+class RankedModelAdminMixin:
+    """Mixin for a ``ModelAdmin`` of a :class:`RankedModel` inheritor that
+    uses the move link helpers below.  The change list ``QuerySet`` is
+    annotated with the highest rank in each row's group (see
+    :class:`RankedQuerySet.with_group_max_rank`) so that the helpers don't
+    need a ``COUNT`` query per row.  Only groups declared with
+    ``rank_group_fields`` can be annotated, other models fall back to
+    counting.
+
+    .. code-block:: python
+
+        @admin.register(Favourites)
+        class FavouritesAdmin(RankedModelAdminMixin, admin.ModelAdmin):
+            list_display = ('name', 'rank', 'move_both')
+
+            def move_both(self, obj):
+                return admin_move_links(obj)
+    """
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.with_group_max_rank()
+
+
 def admin_link_move_up(obj, link_text='↑'):
     """Returns a link to a view that moves the passed in object up in rank.
 
@@ -22,10 +85,7 @@ def admin_link_move_up(obj, link_text='↑'):
     if obj.rank == 1:
         return ''
 
-    content_type = ContentType.objects.get_for_model(obj)
-    link = reverse('awl-rankedmodel-move', args=(content_type.id, obj.id, 
-        obj.rank - 1))
-
+    link = _move_url(obj, obj.rank - 1)
     return format_html('<a href="{}">{}</a>', link, link_text)
 
 
@@ -39,13 +99,10 @@ def admin_link_move_down(obj, link_text='↓'):
     :returns:
         HTML link code to view for moving the object
     """
-    if obj.rank == obj.grouped_filter().count():
+    if obj.rank == _group_max_rank(obj):
         return ''
 
-    content_type = ContentType.objects.get_for_model(obj)
-    link = reverse('awl-rankedmodel-move', args=(content_type.id, obj.id, 
-        obj.rank + 1))
-
+    link = _move_url(obj, obj.rank + 1)
     return format_html('<a href="{}">{}</a>', link, link_text)
 
 
@@ -68,14 +125,12 @@ def admin_move_links(obj, up_text='↑', down_text='↓'):
     if obj.rank == 1:
         show_up = False
 
-    if obj.rank == obj.grouped_filter().count():
+    if obj.rank == _group_max_rank(obj):
         show_down = False
 
     html = f'<span style="width:{len(up_text)+1}ex; display:inline-block">'
     if show_up:
-        content_type = ContentType.objects.get_for_model(obj)
-        link = reverse('awl-rankedmodel-move', args=(content_type.id, obj.id, 
-            obj.rank - 1))
+        link = _move_url(obj, obj.rank - 1)
         html += f'<a href="{link}">{up_text}</a>'
     else:
         html += '&nbsp;'
@@ -83,11 +138,45 @@ def admin_move_links(obj, up_text='↑', down_text='↓'):
     html += '</span>&nbsp;' + \
         f'<span style="width:{len(down_text)+1}ex; display:inline-block">'
     if show_down:
-        content_type = ContentType.objects.get_for_model(obj)
-        link = reverse('awl-rankedmodel-move', 
-            args=(content_type.id, obj.id, obj.rank + 1))
+        link = _move_url(obj, obj.rank + 1)
         html += f'<a href="{link}">{down_text}</a>'
 
     html += '</span>'
 
     return mark_safe(html)
+
+
+def admin_reorder_handle(obj, handle_text='☰'):
+    """Returns a drag handle for re-ordering objects in the django admin
+    change list.  Include the ``awl/rankedmodel/reorder.js`` script in your
+    admin's ``Media`` and rows can be dragged onto each other, each drop is
+    sent to the :func:`awl.rankedmodel.views.reorder` view without
+    re-loading the page.
+
+    .. code-block:: python
+
+        @admin.register(Favourites)
+        class FavouritesAdmin(admin.ModelAdmin):
+            list_display = ('name', 'rank', 'handle')
+
+            class Media:
+                js = ('awl/rankedmodel/reorder.js', )
+
+            def handle(self, obj):
+                return admin_reorder_handle(obj)
+
+    :param obj:
+        Object the handle is for
+    :param handle_text:
+        Text to display as the handle.  Defaults to "☰"
+    :returns:
+        HTML for the drag handle
+    """
+    link = _reorder_url(obj)
+
+    # identifies the group so the script can refuse drops across groups
+    group = hashlib.sha1(repr(obj._group_key()).encode('utf-8')).hexdigest()
+
+    return format_html(('<span class="awl-rank-handle" data-url="{}" '
+        'data-id="{}" data-rank="{}" data-group="{}" style="cursor:move">'
+        '{}</span>'), link, obj.id, obj.rank, group, handle_text)
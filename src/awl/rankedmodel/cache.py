@@ -0,0 +1,220 @@
+# awl.rankedmodel.cache.py
+import hashlib
+import time
+from functools import partial
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import router, transaction
+from django.db.models.signals import post_save
+
+from awl.rankedmodel.signals import ranks_changed
+
+# ============================================================================
+
+class RankCache(object):
+    """Read-through cache of the ordered ids of each group of a
+    :class:`awl.rankedmodel.models.RankedModel` inheritor, and optionally of
+    a rendered version of each object, stored in the Django cache.  Reading
+    a page of a ranked list then costs a cache hit plus, when objects are
+    needed, a single primary key lookup for the page rather than an
+    ``ORDER BY rank`` scan of the group.
+
+    Each group's entries are keyed by a version number.  The version is
+    bumped when the :data:`awl.rankedmodel.signals.ranks_changed` signal is
+    sent for the group, which includes deletes, or after an object in the
+    group is saved, so stale entries are never read and simply expire.  As
+    the version is bumped after the change commits, a reader racing with the
+    change can only write its stale result under the old version.
+
+    .. code-block:: python
+
+        # module level, so the signal handlers are registered once
+        track_cache = RankCache(Track,
+            render=lambda track: render_to_string('track.html',
+                {'track':track}))
+
+        tracks = track_cache.slice(0, 20, album_id=album.id)
+        rows = track_cache.rows(0, 20, album_id=album.id)
+
+    Groups are given either as keyword arguments naming the columns of the
+    ``rank_group_fields`` (``album_id=3``), or with ``obj``, any object in
+    the group.  Models with no group fields take no arguments, models that
+    override ``grouped_filter()`` without ``rank_group_fields`` must use
+    ``obj``.
+
+    Changes made through ``update()`` or raw SQL bypass the signals, call
+    :class:`RankCache.invalidate` after making them.
+    """
+    def __init__(self, model, render=None, timeout=None,
+            cache=DEFAULT_CACHE_ALIAS):
+        """Constructor
+
+        :param model:
+            ``RankedModel`` inheritor to cache
+        :param render:
+            Optional callable that takes an object and returns the
+            (picklable) value cached for it by :class:`RankCache.rows`, for
+            example a string of HTML
+        :param timeout:
+            Timeout in seconds for the cached entries, defaults to the
+            cache's own default
+        :param cache:
+            Alias of the Django cache to use.  Defaults to "default"
+        """
+        self.model = model
+        self.render = render
+        self.cache_alias = cache
+        self.timeout = {} if timeout is None else {'timeout':timeout}
+
+        self.dispatch_uid = 'awl.rankedmodel.cache.%s.%s' % (
+            model._meta.label, id(self))
+        ranks_changed.connect(self._ranks_changed, sender=model, weak=False,
+            dispatch_uid=self.dispatch_uid)
+        post_save.connect(self._saved, sender=model, weak=False,
+            dispatch_uid=self.dispatch_uid)
+
+    def disconnect(self):
+        """Stops listening for changes to the model, the cache is no
+        longer invalidated."""
+        for signal in (ranks_changed, post_save):
+            signal.disconnect(sender=self.model,
+                dispatch_uid=self.dispatch_uid)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    # --- Keys and Versions
+    def _group_obj(self, obj, values):
+        if obj is not None:
+            return obj
+
+        # stand-in object for the group, only used to filter it
+        return self.model(**values)
+
+    def _prefix(self, group):
+        digest = hashlib.sha1(repr(group).encode('utf-8')).hexdigest()
+        return 'awl.rankcache.%s.%s' % (self.model._meta.label, digest)
+
+    def _version(self, prefix):
+        key = prefix + '.version'
+        version = self.cache.get(key)
+        if version is None:
+            # start from the clock so that a version lost to eviction isn't
+            # re-used, add() keeps the first writer's value
+            self.cache.add(key, time.time_ns(), timeout=None)
+            version = self.cache.get(key)
+
+        return version
+
+    def _bump(self, group):
+        key = self._prefix(group) + '.version'
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # not cached, the next read starts a new version
+            pass
+
+    def _ranks_changed(self, sender, group, **kwargs):
+        self._bump(group)
+
+    def _saved(self, sender, instance, **kwargs):
+        using = router.db_for_write(sender, instance=instance)
+        transaction.on_commit(partial(self._bump, instance._group_key()),
+            using=using)
+
+    def invalidate(self, obj=None, **values):
+        """Discards the cached entries of a group.
+
+        :param obj:
+            Object in the group, used instead of the group values
+        :param values:
+            Values of the group fields
+        """
+        self._bump(self._group_obj(obj, values)._group_key())
+
+    # --- Reading
+    def ids(self, obj=None, **values):
+        """Returns the primary keys of a group's objects in rank order,
+        querying the database only when they aren't cached.
+
+        :param obj:
+            Object in the group, used instead of the group values
+        :param values:
+            Values of the group fields
+        :returns:
+            List of primary keys
+        """
+        obj = self._group_obj(obj, values)
+        prefix = self._prefix(obj._group_key())
+        key = '%s.%s.ids' % (prefix, self._version(prefix))
+
+        ids = self.cache.get(key)
+        if ids is None:
+            ids = list(obj.grouped_filter().order_by('rank', 
+                'pk').values_list('pk', flat=True))
+            self.cache.set(key, ids, **self.timeout)
+
+        return ids
+
+    def slice(self, start, stop, obj=None, **values):
+        """Returns a slice of a group's objects in rank order.  The ids come
+        from the cache and the objects are fetched with a single primary key
+        lookup.  Objects deleted since the ids were cached are left out.
+
+        :param start:
+            Index of the first object in the slice
+        :param stop:
+            Index after the last object in the slice
+        :param obj:
+            Object in the group, used instead of the group values
+        :param values:
+            Values of the group fields
+        :returns:
+            List of objects
+        """
+        ids = self.ids(obj, **values)[start:stop]
+        found = self.model._default_manager.in_bulk(ids)
+        return [found[pk] for pk in ids if pk in found]
+
+    def rows(self, start, stop, obj=None, **values):
+        """Returns the rendered values of a slice of a group's objects in
+        rank order, see the ``render`` parameter to the constructor.  Only
+        the objects whose rendered values aren't cached are fetched and
+        rendered.
+
+        :param start:
+            Index of the first object in the slice
+        :param stop:
+            Index after the last object in the slice
+        :param obj:
+            Object in the group, used instead of the group values
+        :param values:
+            Values of the group fields
+        :returns:
+            List of rendered values
+        :raises TypeError:
+            If no ``render`` callable was given
+        """
+        if self.render is None:
+            raise TypeError('RankCache for %s has no render callable' % (
+                self.model._meta.label))
+
+        obj = self._group_obj(obj, values)
+        ids = self.ids(obj)[start:stop]
+        prefix = self._prefix(obj._group_key())
+        version = self._version(prefix)
+        keys = {pk:'%s.%s.row.%s' % (prefix, version, pk) for pk in ids}
+
+        cached = self.cache.get_many(keys.values())
+        missing = [pk for pk in ids if keys[pk] not in cached]
+        if missing:
+            rendered = {}
+            for pk, item in self.model._default_manager.in_bulk(
+                    missing).items():
+                rendered[keys[pk]] = self.render(item)
+
+            self.cache.set_many(rendered, **self.timeout)
+            cached.update(rendered)
+
+        return [cached[keys[pk]] for pk in ids if keys[pk] in cached]
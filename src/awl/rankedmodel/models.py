@@ -1,5 +1,267 @@
 # awl.rankedmodel.models.py
-from django.db import models, transaction
+import hashlib
+import threading
+import zlib
+from contextlib import contextmanager
+from functools import partial, wraps
+
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, When
+from django.db.models.signals import class_prepared
+
+from awl.rankedmodel.signals import ranks_changed
+
+# ============================================================================
+
+class RankedQuerySet(models.QuerySet):
+    """``QuerySet`` used as the default manager for :class:`RankedModel`
+    inheritors.  Deletes done through the queryset close the gaps they leave
+    behind, recomputing the ranks once for each affected group rather than
+    once per deleted row.
+    """
+    def delete(self):
+        # keep one (soon to be deleted) object from each group so its
+        # grouped_filter() can be used to find the survivors afterwards,
+        # along with the range of ranks being removed
+        model = self.model
+        objs = self.select_related(None).prefetch_related(None)
+        if model.rank_group_fields or \
+                model.grouped_filter is RankedModel.grouped_filter:
+            # only the group fields are needed, an overridden
+            # grouped_filter() may read any field so gets whole objects
+            objs = objs.only('pk', 'rank', *model.rank_group_fields)
+
+        with transaction.atomic(using=self.db):
+            groups = {}
+            for obj in objs:
+                key = obj._group_key()
+                first, low, high = groups.get(key, (obj, obj.rank, obj.rank))
+                groups[key] = (first, min(low, obj.rank), max(high, obj.rank))
+
+            # lock every group before deleting anything, in the same order
+            # that saves moving between groups use so the two can't deadlock
+            for key in sorted(groups, key=repr):
+                obj = groups[key][0]
+                if _active_batch(obj) is None:
+                    obj._lock_group()
+
+            result = super(RankedQuerySet, self).delete()
+            for obj, low, high in groups.values():
+                batch = _active_batch(obj)
+                if batch is None:
+                    obj._repack(low, high)
+                else:
+                    batch.discard(obj)
+
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def with_group_max_rank(self):
+        """Annotates each object with ``rank_group_max``, the highest rank
+        in its group, using a correlated subquery served by the group and
+        rank index.  Only models that declare their groups through
+        ``rank_group_fields`` (or have a single group) can be annotated,
+        others are returned unchanged.
+        """
+        model = self.model
+        if not model.rank_group_fields and \
+                model.grouped_filter is not RankedModel.grouped_filter:
+            return self
+
+        highest = model._default_manager.filter(**{name:OuterRef(name) 
+            for name in model.rank_group_fields}).order_by('-rank').values(
+            'rank')[:1]
+        return self.annotate(rank_group_max=Subquery(highest))
+
+# ----------------------------------------------------------------------------
+
+class RankConflictError(Exception):
+    """Raised when an optimistic :class:`RankedModel` change keeps
+    colliding with concurrent changes to the same group and has run out of
+    retries."""
+    pass
+
+
+class _VersionConflict(Exception):
+    # a group's version changed underneath an optimistic rank change
+    pass
+
+
+def _rank_operation(method):
+    # Runs a RankedModel method that changes ranks in a transaction.  For
+    # inheritors using optimistic concurrency the group versions read while
+    # running are compared-and-swapped at the end, on a conflict the
+    # transaction is rolled back and the method retried
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _active_batch(self) is not None:
+            # only buffering, the batch's own transaction covers any writes
+            return method(self, *args, **kwargs)
+
+        if not self.rank_optimistic or self._rank_versions is not None:
+            # pessimistic locking, or nested inside another operation
+            with transaction.atomic():
+                return method(self, *args, **kwargs)
+
+        state = (self.pk, self.rank, self._rank_at_load, self._group_at_load,
+            self._state.adding, self._state.db)
+        for attempt in range(self.rank_optimistic_retries + 1):
+            self._rank_versions = {}
+            try:
+                with transaction.atomic():
+                    result = method(self, *args, **kwargs)
+                    self._swap_versions()
+
+                return result
+            except _VersionConflict:
+                # put the object back the way it was before trying again
+                (self.pk, self.rank, self._rank_at_load, self._group_at_load,
+                    self._state.adding, self._state.db) = state
+            finally:
+                self._rank_versions = None
+
+        raise RankConflictError('Gave up on %s.%s() after %s attempts' % (
+            self._meta.label, method.__name__, attempt + 1))
+
+    return wrapper
+
+# ----------------------------------------------------------------------------
+
+_batches = threading.local()
+
+def _active_batch(obj):
+    # returns the batch() that is buffering changes to obj, if any
+    for batch in getattr(_batches, 'stack', []):
+        if isinstance(obj, batch.model):
+            return batch
+
+    return None
+
+
+class _RankBatch:
+    # Buffers rank changes made during RankedModel.batch().  Changes are
+    # recorded as (object, kind, target) intents per group and replayed in
+    # order against each group's ordering when the batch is flushed.  The
+    # kind is "rank" with a requested rank as the target, or "above",
+    # "below" or "swap" with another object in the group as the target
+
+    def __init__(self, model):
+        self.model = model
+        self.groups = {}
+
+    def _group(self, obj, values=None):
+        if values is None and obj.rank_group_fields:
+            # copy the values now, obj may change groups later
+            values = obj._group_values()
+
+        key = (obj._meta.label, repr(obj._group_key(values)))
+        if key not in self.groups:
+            self.groups[key] = {
+                'obj':obj,
+                'values':values,
+                'intents':[],
+                'outsiders':[],
+                'removed':False,
+            }
+
+        return self.groups[key]
+
+    def _forget(self, obj):
+        for group in self.groups.values():
+            group['intents'] = [intent for intent in group['intents'] 
+                if intent[0] is not obj and intent[2] is not obj]
+
+    def insert(self, obj, rank, outsider=True):
+        # obj joins its group, rank of None means the end of the group
+        group = self._group(obj)
+        group['intents'].append((obj, 'rank', rank))
+        if outsider:
+            group['outsiders'].append(obj)
+
+    def place(self, obj, kind, other):
+        # obj moves relative to another object in its group
+        self._group(obj)['intents'].append((obj, kind, other))
+
+    def leave(self, obj, values):
+        # obj has left the group given by values
+        self._group(obj, values)['removed'] = True
+
+    def discard(self, obj):
+        # obj has been deleted from its group
+        self._forget(obj)
+        self._group(obj)['removed'] = True
+
+    def flush(self):
+        # groups are processed in a consistent order to avoid deadlocks
+        for key in sorted(self.groups.keys()):
+            group = self.groups[key]
+            obj = group['obj']
+            obj._lock_group(group['values'])
+            items = obj._group_items(group['values'])
+
+            outsiders = set(member.pk for member in group['outsiders'])
+            ranks = dict(items.values_list('pk', 'rank'))
+
+            # deleted objects may still have intents, drop them
+            intents = [(member, kind, target) for member, kind, target in 
+                group['intents'] if member.pk in ranks and (kind == 'rank' 
+                or target.pk in ranks)]
+
+            ordering = obj._derived_ordering()
+            if ordering is not None:
+                # ranks come from other fields, the intents only mark the
+                # group as changed
+                order = list(items.order_by(*ordering).values_list('pk', 
+                    flat=True))
+            else:
+                order = [pk for pk, rank in sorted(ranks.items(), 
+                    key=lambda item: (item[1], item[0])) 
+                    if pk not in outsiders]
+
+                for member, kind, target in intents:
+                    if kind == 'swap':
+                        first = order.index(member.pk)
+                        second = order.index(target.pk)
+                        order[first], order[second] = target.pk, member.pk
+                        continue
+
+                    if member.pk in order:
+                        order.remove(member.pk)
+
+                    if kind == 'above':
+                        order.insert(order.index(target.pk), member.pk)
+                    elif kind == 'below':
+                        order.insert(order.index(target.pk) + 1, member.pk)
+                    elif target is None or target > len(order) + 1:
+                        order.append(member.pk)
+                    else:
+                        order.insert(max(target, 1) - 1, member.pk)
+
+            changed = []
+            for rank, pk in enumerate(order, start=1):
+                if ranks.get(pk) != rank:
+                    changed.append(obj.__class__(pk=pk, rank=rank))
+
+            obj.__class__.objects.bulk_update(changed, ['rank'])
+
+            if changed:
+                obj._ranks_changed(changed[0].rank, changed[-1].rank,
+                    group['values'])
+            elif group['removed']:
+                # objects only left the end of the group
+                obj._ranks_changed(len(order) + 1, len(order) + 1,
+                    group['values'])
+
+            final = {pk:rank for rank, pk in enumerate(order, start=1)}
+            for member, kind, target in intents:
+                members = (member, target) if kind == 'swap' else (member, )
+                for moved in members:
+                    moved.rank = final[moved.pk]
+                    moved._rank_at_load = moved.rank
+                    moved._group_at_load = moved._loaded_group_values()
+                    moved._batch_rank = None
 
 # ============================================================================
 
@@ -12,14 +274,18 @@ class RankedModel(models.Model):
     The ``rank`` field can be set and saved like any other field.  The
     overridden :class:`RankedModel.save` method maintains rank integrity.  The
     order is maintained but it is not guaranteed that there are not gaps in
-    the rank count -- for simplicity re-ordering is not done on deletion.  If
-    empty slots are a concern, use :class:`RankedModel.repack`.
+    the rank count if rows are modified outside of the model.  Deleting an
+    object, or a ``QuerySet`` of objects through the default manager, closes
+    the gap left behind.  If other empty slots are a concern, use
+    :class:`RankedModel.repack`.
 
     .. warning::
 
         Due to the use of the overridden ``save()`` caution must be employed
         when dealing with any ``update()`` calls or raw SQL as these will not
-        call the ``save()`` method.
+        call the ``save()`` method.  Similarly, inheritors that replace the
+        ``objects`` manager should base it on :class:`RankedQuerySet` so that
+        bulk deletes still close their gaps.
 
     Two admin helper functions are provided so you can do rank re-ordering in
     the django admin.  To use the functions, add columns to your admin
@@ -42,11 +308,72 @@ class RankedModel(models.Model):
             move_down.allow_tags = True
             move_down.short_description = 'Move Down Rank'
 
+    The ``rank`` field defaults to a ``PositiveSmallIntegerField`` which
+    limits a group to 32767 entries.  Inheritors needing larger lists can
+    re-declare the field with a wider type::
+
+        class Entry(RankedModel):
+            rank = models.PositiveIntegerField(db_index=True)
+
+    Groups are declared by listing the fields that define them in
+    ``rank_group_fields``.  The group is used to build the default
+    :class:`RankedModel.grouped_filter`, and a composite index on those
+    fields plus ``rank`` is automatically added to the model (and therefore
+    to its migrations) so that ordered scans and rank range updates within a
+    group are served from the index::
+
+        class Track(RankedModel):
+            album = models.ForeignKey(Album, on_delete=models.CASCADE)
+
+            rank_group_fields = ('album', )
+
+    Changes to the ranks lock only the group being changed: the parent row
+    when a group field is a ``ForeignKey``, a transaction level advisory lock
+    on PostgreSQL, otherwise the rows in the group.
+
+    Inheritors expecting little contention can set ``rank_optimistic`` to
+    True.  Instead of locking, each group's version is read (from a
+    :class:`awl.models.RankVersion` row) and, once the change has been
+    made, compared-and-swapped for the next version.  If another writer
+    changed the group in the meantime the transaction is rolled back and
+    the change retried up to ``rank_optimistic_retries`` times, after which
+    :class:`RankConflictError` is raised.  This mode requires ``awl`` in
+    ``INSTALLED_APPS`` for the version table.
+
+    Changing the value of a group field and saving moves the object between
+    groups: the gap in the old group is closed and the object is inserted
+    at its ``rank`` in the new group, or at the end of the new group if the
+    rank wasn't changed.  Moves between groups are only detected for groups
+    declared through ``rank_group_fields``.
+
+    Rather than listening for ``post_save`` on every row, caches and
+    indexes that depend on the order can listen for
+    :data:`awl.rankedmodel.signals.ranks_changed`, sent once per changed
+    group after each operation commits with the range of ranks affected.
+
     :param rank:
         Ranked order of object
     """
     rank = models.PositiveSmallIntegerField(db_index=True)
 
+    #: Names of the fields that define a group, used to filter and lock the
+    #: group and to generate a composite ``(*rank_group_fields, rank)`` index
+    rank_group_fields = ()
+
+    #: Set to True to use optimistic concurrency instead of group locks
+    rank_optimistic = False
+
+    #: Number of times an optimistic change is retried on conflict
+    rank_optimistic_retries = 3
+
+    # group versions read during an optimistic operation
+    _rank_versions = None
+
+    # rank stored in the row while a batch() holds this object's change
+    _batch_rank = None
+
+    objects = RankedQuerySet.as_manager()
+
     class Meta:
         abstract = True
         ordering = ['rank']
@@ -54,36 +381,111 @@ class RankedModel(models.Model):
     def __init__(self, *args, **kwargs):
         super(RankedModel, self).__init__(*args, **kwargs)
         self._rank_at_load = self.rank
+        self._group_at_load = self._loaded_group_values()
+
+    def _loaded_group_values(self):
+        # group values as currently held in memory, None if any of them are
+        # deferred (reading them here would cost a query per object)
+        values = {}
+        for name in self.rank_group_fields:
+            field = self._meta.get_field(name)
+            if field.attname not in self.__dict__:
+                return None
+
+            values[field.attname] = field.to_python(
+                self.__dict__[field.attname])
+
+        return values
+
+    def _lock_group(self, values=None):
+        # Serializes rank changes within a group without locking every row
+        # in it. Groups that hang off a foreign key lock the parent row,
+        # PostgreSQL uses a transaction level advisory lock keyed on the
+        # group, anything else falls back to locking the rows of the group.
+        # Locks this object's group unless group values are given
+        if values is None:
+            values = self._group_values()
+
+        using = router.db_for_write(self.__class__, instance=self)
+        if self._rank_versions is not None:
+            self._read_version(using, values)
+            return
+
+        for name in self.rank_group_fields:
+            field = self._meta.get_field(name)
+            value = values[field.attname]
+            if field.many_to_one and value is not None:
+                parent = field.related_model._base_manager.using(using)
+                list(parent.select_for_update().filter(
+                    **{field.target_field.attname:value}).values_list('pk'))
+                return
+
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [
+                    _lock_id(self._meta.label), 
+                    _lock_id(repr(self._group_key(values)))])
+            return
+
+        items = self._group_items(values)
+        list(items.select_for_update().values_list('pk'))
+
+    def _version_key(self, values):
+        # (model label, hashed group key) identifying a RankVersion row
+        key = repr(self._group_key(values)).encode('utf-8')
+        return (self._meta.label, hashlib.sha1(key).hexdigest())
+
+    def _read_version(self, using, values):
+        # optimistic replacement for locking: remember the group's version
+        from awl.models import RankVersion
+
+        label, group = self._version_key(values)
+        if (label, group) not in self._rank_versions:
+            version, _ = RankVersion.objects.using(using).get_or_create(
+                model=label, group=group)
+            self._rank_versions[(label, group)] = (using, version.version)
+
+    def _swap_versions(self):
+        # compare-and-swap each version read during the operation
+        from awl.models import RankVersion
+
+        for (label, group), (using, version) in self._rank_versions.items():
+            updated = RankVersion.objects.using(using).filter(model=label,
+                group=group, version=version).update(
+                version=F('version') + 1)
+            if not updated:
+                raise _VersionConflict()
 
     def _process_new_rank_obj(self):
         # no id yet, this is the first time this object has been saved
+        self._lock_group()
+        self._apply_derived_rank()
         rank = getattr(self, 'rank', None)
-        items = self.grouped_filter().order_by(
-            'rank').select_for_update()
+        items = self.grouped_filter()
         count = items.count()
-        if count == 0:
+        if not rank or rank > count + 1:
+            # rank not set yet, or was set larger than largest item
+            self.rank = count + 1
+        elif rank < 1:
             self.rank = 1
-        else:
-            if not rank or rank > count + 1:
-                # rank not set yet, or was set larger than largest item
-                self.rank = count + 1
-            elif rank < 1:
-                self.rank = 1
-
-            # count >= 1, need to move everybody else
 
-            # rank was set to a specific value, need to re-order
-            # everything that comes after it in the list
-            for item in items[self.rank - 1:]:
-                item.rank +=1
-                item._rank_at_load = item.rank
-                item.save(rerank=False)
+        shifted = 0
+        if self.rank <= count:
+            # rank was set to a specific value, need to re-order everything
+            # that comes after it in the list
+            shifted = items.filter(rank__gte=self.rank).update(
+                rank=F('rank') + 1)
 
         self._rank_at_load = self.rank
+        self._ranks_changed(self.rank, self.rank + shifted)
 
     def _process_moved_rank_obj(self):
         # rank changed, re-order it
-        items = self.grouped_filter().order_by('rank').select_for_update()
+        self._lock_group()
+        self._refresh_rank_at_load()
+        self._apply_derived_rank()
+        items = self.grouped_filter()
         count = items.count()
 
         # check bounds on new rank
@@ -92,23 +494,103 @@ class RankedModel(models.Model):
         elif self.rank > count:
             self.rank = count
 
+        items = items.exclude(pk=self.pk)
         if self.rank < self._rank_at_load:
-            # rank moved down
-            start = self.rank - 1
-            end = self._rank_at_load - 1
-            delta = 1
-        else:
-            # rank moved up
-            start = self._rank_at_load
-            end = self.rank
-            delta = -1
+            # rank moved down, everything in between moves up
+            items.filter(rank__gte=self.rank, 
+                rank__lt=self._rank_at_load).update(rank=F('rank') + 1)
+        elif self.rank > self._rank_at_load:
+            # rank moved up, everything in between moves down
+            items.filter(rank__gt=self._rank_at_load, 
+                rank__lte=self.rank).update(rank=F('rank') - 1)
+
+        if self.rank != self._rank_at_load:
+            self._ranks_changed(min(self.rank, self._rank_at_load),
+                max(self.rank, self._rank_at_load))
+
+    def _refresh_rank_at_load(self):
+        # other objects may have shifted this one since it was loaded, once
+        # the group is locked re-read its rank from the database
+        rank = self.__class__.objects.filter(pk=self.pk).values_list('rank',
+            flat=True).first()
+        if rank is not None:
+            self._rank_at_load = rank
+
+    def _rank_changed(self):
+        return self.rank != self._rank_at_load
+
+    def _derived_rank(self):
+        # hook for inheritors that calculate the rank from other fields,
+        # called with the group locked; None keeps the requested rank
+        return None
+
+    def _derived_ordering(self):
+        # hook for inheritors that calculate the rank from other fields,
+        # the order_by() arguments that give the ranked order of a group
+        return None
+
+    def _apply_derived_rank(self):
+        rank = self._derived_rank()
+        if rank is None:
+            return False
+
+        self.rank = rank
+        return True
+
+    def _group_changed(self):
+        return self._group_at_load is not None and \
+            self._group_at_load != self._group_values()
+
+    def _process_group_change_obj(self):
+        # object moved between groups: close the gap in the old group and
+        # open one in the new group, locking the two groups in a consistent
+        # order so that opposing moves can't deadlock
+        old_values = self._group_at_load
+        new_values = self._group_values()
+        for values in sorted([old_values, new_values], 
+                key=lambda values: repr(tuple(values.values()))):
+            self._lock_group(values)
+
+        # whether a rank was asked for is judged against the rank this
+        # object was loaded with, before it is refreshed
+        rank_requested = self.rank != self._rank_at_load
+        self._refresh_rank_at_load()
+        shifted = self._group_items(old_values).exclude(pk=self.pk).filter(
+            rank__gt=self._rank_at_load).update(rank=F('rank') - 1)
+        self._ranks_changed(self._rank_at_load, self._rank_at_load + shifted,
+            old_values)
 
-        for item in items[start:end]:
-            item.rank += delta
-            item._rank_at_load = item.rank
-            item.save(rerank=False)
+        items = self.grouped_filter().exclude(pk=self.pk)
+        count = items.count()
+        if self._apply_derived_rank():
+            pass
+        elif not rank_requested or not self.rank or \
+                self.rank > count + 1:
+            # no new rank requested, or was set larger than largest item
+            self.rank = count + 1
+        elif self.rank < 1:
+            self.rank = 1
+
+        shifted = 0
+        if self.rank <= count:
+            shifted = items.filter(rank__gte=self.rank).update(
+                rank=F('rank') + 1)
+
+        self._ranks_changed(self.rank, self.rank + shifted, new_values)
 
-    @transaction.atomic
+    def _ranks_changed(self, low, high, values=None):
+        # sends the ranks_changed signal for the group with the given values
+        # (defaults to this object's group) once the transaction commits
+        if values is None:
+            values = self._group_values()
+
+        using = router.db_for_write(self.__class__, instance=self)
+        transaction.on_commit(partial(ranks_changed.send, 
+            sender=self.__class__, group=self._group_key(values), 
+            values=dict(values), low=low, high=high, using=using), 
+            using=using)
+
+    @_rank_operation
     def save(self, *args, **kwargs):
         """Overridden method that handles that re-ranking of objects and the
         integrity of the ``rank`` field.
@@ -118,40 +600,545 @@ class RankedModel(models.Model):
             change in this save.  Defaults to True.  
         """
         rerank = kwargs.pop('rerank', True)
+        batch = _active_batch(self) if rerank else None
+        if batch is not None:
+            self._batch_save(batch, *args, **kwargs)
+            return
+
         if rerank:
             if not self.id:
                 self._process_new_rank_obj()
-            elif self.rank == self._rank_at_load:
-                # nothing changed
-                pass
-            else:
+            elif self._group_changed():
+                self._process_group_change_obj()
+            elif self._rank_changed():
                 self._process_moved_rank_obj()
 
         super(RankedModel, self).save(*args, **kwargs)
+        self._rank_at_load = self.rank
+        self._group_at_load = self._loaded_group_values()
+
+    # --- Relative Moves
+    def _check_movable(self, *objs):
+        # raises an error unless the given objects are in this one's group
+        for obj in objs:
+            if obj.__class__ is not self.__class__ or \
+                    obj._group_key() != self._group_key():
+                raise ValueError('%r is not in the same group as %r' % (obj,
+                    self))
+
+    def _locked_ranks(self, *objs):
+        # locks the group and returns a pk -> rank mapping from the database
+        # for this object and the given ones
+        self._check_movable(*objs)
+        self._lock_group()
+        pks = [self.pk] + [obj.pk for obj in objs]
+        ranks = dict(self.grouped_filter().filter(pk__in=pks).values_list(
+            'pk', 'rank'))
+        for obj in (self, ) + objs:
+            if obj.pk not in ranks:
+                raise obj.DoesNotExist('%r is not stored in its group, it '
+                    'was deleted or has an unsaved group change' % obj)
+
+        return ranks
+
+    def _move_from(self, current, rank=None):
+        # moves this object from its current database rank to the given
+        # rank (or the bottom of the group if None) with a single shift of
+        # the objects in between
+        items = self.grouped_filter()
+        count = items.count()
+        if rank is None or rank > count:
+            rank = count
+        elif rank < 1:
+            rank = 1
+
+        items = items.exclude(pk=self.pk)
+        if rank < current:
+            items.filter(rank__gte=rank, rank__lt=current).update(
+                rank=F('rank') + 1)
+        elif rank > current:
+            items.filter(rank__gt=current, rank__lte=rank).update(
+                rank=F('rank') - 1)
+
+        if rank != current:
+            self.__class__.objects.filter(pk=self.pk).update(rank=rank)
+            self._ranks_changed(min(rank, current), max(rank, current))
+
+        self.rank = rank
+        self._rank_at_load = rank
+
+    @_rank_operation
+    def move_to(self, rank):
+        """Moves this object to the given rank within its group.  Unlike
+        changing the ``rank`` field and calling ``save()``, only the ranks
+        are written, using a fixed number of statements regardless of the
+        size of the group.  The rank is re-read from the database so a stale
+        in-memory object still moves correctly.
+
+        .. note::
+
+            Relative moves use ``update()`` and so do not send ``pre_save``
+            or ``post_save`` signals.
+
+        Inside of a :class:`RankedModel.batch` this and the other relative
+        moves are recorded and applied with the rest of the batch, even if
+        ``rank`` is the same as the object's current rank.
+
+        :param rank:
+            New rank, values outside of the group's range are moved to the
+            nearest end
+        :raises DoesNotExist:
+            If the object is not stored in its group, because it was deleted
+            or has an unsaved group change
+        """
+        batch = _active_batch(self)
+        if batch is not None:
+            self._check_movable()
+            batch.insert(self, rank, outsider=False)
+            return
+
+        current = self._locked_ranks()[self.pk]
+        self._move_from(current, rank)
+
+    def move_to_top(self):
+        """Moves this object to the first rank in its group."""
+        self.move_to(1)
+
+    @_rank_operation
+    def move_to_bottom(self):
+        """Moves this object to the last rank in its group."""
+        batch = _active_batch(self)
+        if batch is not None:
+            self._check_movable()
+            batch.insert(self, None, outsider=False)
+            return
+
+        current = self._locked_ranks()[self.pk]
+        self._move_from(current)
+
+    @_rank_operation
+    def move_above(self, other):
+        """Moves this object so that it is ranked directly before another.
+
+        :param other:
+            Object in the same group to move in front of
+        :raises ValueError:
+            If ``other`` is not in the same group
+        """
+        batch = _active_batch(self)
+        if batch is not None:
+            self._check_movable(other)
+            batch.place(self, 'above', other)
+            return
+
+        ranks = self._locked_ranks(other)
+        current = ranks[self.pk]
+        target = ranks[other.pk]
+        if current < target:
+            target -= 1
+
+        self._move_from(current, target)
+
+    @_rank_operation
+    def move_below(self, other):
+        """Moves this object so that it is ranked directly after another.
+
+        :param other:
+            Object in the same group to move behind
+        :raises ValueError:
+            If ``other`` is not in the same group
+        """
+        batch = _active_batch(self)
+        if batch is not None:
+            self._check_movable(other)
+            batch.place(self, 'below', other)
+            return
+
+        ranks = self._locked_ranks(other)
+        current = ranks[self.pk]
+        target = ranks[other.pk]
+        if current > target:
+            target += 1
+
+        self._move_from(current, target)
+
+    @_rank_operation
+    def swap(self, other):
+        """Swaps the ranks of this object and another using a single
+        ``UPDATE`` statement.
+
+        :param other:
+            Object in the same group to swap places with
+        :raises ValueError:
+            If ``other`` is not in the same group
+        """
+        batch = _active_batch(self)
+        if batch is not None:
+            self._check_movable(other)
+            batch.place(self, 'swap', other)
+            return
+
+        ranks = self._locked_ranks(other)
+        self.__class__.objects.filter(pk__in=ranks.keys()).update(
+            rank=Case(
+                When(pk=self.pk, then=ranks[other.pk]),
+                When(pk=other.pk, then=ranks[self.pk]),
+            ))
+
+        self.rank = self._rank_at_load = ranks[other.pk]
+        other.rank = other._rank_at_load = ranks[self.pk]
+        if self.rank != other.rank:
+            self._ranks_changed(min(self.rank, other.rank), 
+                max(self.rank, other.rank))
+
+    # --- Neighbour Queries
+    def neighbours(self, before=1, after=1):
+        """Returns the objects ranked around this one in its group, based on
+        this object's rank as loaded.  Uses a single range query on the
+        group and rank.
+
+        :param before:
+            Number of objects ranked before this one to include.  Defaults
+            to 1
+        :param after:
+            Number of objects ranked after this one to include.  Defaults to
+            1
+        :returns:
+            :class:`QuerySet` in rank order, not including this object
+        """
+        return self.grouped_filter().filter(rank__gte=self.rank - before,
+            rank__lte=self.rank + after).exclude(pk=self.pk).order_by('rank')
+
+    def previous(self):
+        """Returns the object ranked directly before this one in its group,
+        or None if this is the first one."""
+        return self.grouped_filter().filter(rank__lt=self.rank).order_by(
+            '-rank').first()
+
+    def next(self):
+        """Returns the object ranked directly after this one in its group,
+        or None if this is the last one."""
+        return self.grouped_filter().filter(rank__gt=self.rank).order_by(
+            'rank').first()
+
+    @classmethod
+    def page_around(cls, obj, size):
+        """Returns a page of objects from ``obj``'s group with ``obj`` as
+        close to the middle as possible.  Pages near the start or end of the
+        group are shifted so they are still full when the group is large
+        enough.  A single range query on the group and rank fetches at most
+        ``2 * size - 1`` rows.
+
+        :param obj:
+            Object to centre the page on
+        :param size:
+            Number of objects in the page
+        :returns:
+            List of objects in rank order, including ``obj``
+        """
+        items = list(obj.grouped_filter().filter(rank__gt=obj.rank - size,
+            rank__lt=obj.rank + size).order_by('rank'))
+
+        pks = [item.pk for item in items]
+        if obj.pk not in pks:
+            return items[:size]
+
+        start = pks.index(obj.pk) - (size - 1) // 2
+        start = max(min(start, len(items) - size), 0)
+        return items[start:start + size]
+
+    def _batch_save(self, batch, *args, **kwargs):
+        # inside of a batch() the row is written without touching the ranks
+        # of the group: new and moved-in objects get a placeholder rank,
+        # existing objects keep their old one.  The requested rank is
+        # recorded and applied when the batch ends.  Saving again before
+        # then keeps the stored rank and records any further change
+        stored = self._batch_rank
+        requested = self.rank
+        if not self.id:
+            batch.insert(self, requested or None)
+            stored = 0
+        elif self._group_changed():
+            batch.leave(self, self._group_at_load)
+            if requested == self._rank_at_load:
+                requested = None
+
+            batch.insert(self, requested)
+            stored = 0
+        elif self._rank_changed():
+            batch.insert(self, requested, outsider=False)
+            if stored is None:
+                stored = self._rank_at_load
+
+        if stored is not None:
+            self.rank = stored
+
+        super(RankedModel, self).save(*args, **kwargs)
+        self.rank = requested
+        if stored is not None:
+            self._batch_rank = stored
+            self._rank_at_load = requested
+            self._group_at_load = self._loaded_group_values()
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """Context manager that defers re-ranking.  Inside the block,
+        saves, deletes and relative moves of this class's objects (or any
+        ``RankedModel`` when called on the base class) write their rows
+        without touching the rest of the group.  On exit the final ordering of each affected group
+        is computed once, applying the changes in the order they were made,
+        and written with a bulk update per group.  The whole block runs in a
+        transaction.
+
+        .. code-block:: python
+
+            with Favourite.batch():
+                for rank, fave in enumerate(reversed(faves), start=1):
+                    fave.rank = rank
+                    fave.save()
+
+        Ranks read from the database inside the block are not yet final.
+        Nested calls join the outer batch.
+        """
+        stack = _batches.__dict__.setdefault('stack', [])
+        if any(issubclass(cls, batch.model) for batch in stack):
+            yield
+            return
+
+        batch = _RankBatch(cls)
+        with transaction.atomic(using=router.db_for_write(cls)):
+            stack.append(batch)
+            try:
+                yield
+            finally:
+                stack.remove(batch)
+
+            batch.flush()
+
+    @_rank_operation
+    def delete(self, *args, **kwargs):
+        """Overridden method that closes the gap left in the group by the
+        deleted object.  All objects ranked after this one are moved up with
+        a single ``UPDATE`` statement.
+        """
+        batch = _active_batch(self)
+        if batch is not None:
+            result = super(RankedModel, self).delete(*args, **kwargs)
+            batch.discard(self)
+            return result
+
+        self._lock_group()
+        self._refresh_rank_at_load()
+        result = super(RankedModel, self).delete(*args, **kwargs)
+        shifted = self.grouped_filter().filter(
+            rank__gt=self._rank_at_load).update(rank=F('rank') - 1)
+        self._ranks_changed(self._rank_at_load, self._rank_at_load + shifted)
+        return result
 
     def grouped_filter(self):
-        """This method should be overridden in order to allow groupings of
-        ``RankModel`` objects.  The default is there is a single group which
-        are all instances of the inheriting class.  
+        """Returns the objects in the same group as this one.  The default
+        filters on the fields named in ``rank_group_fields``, with no group
+        fields there is a single group which are all instances of the
+        inheriting class.  
 
         An example with a grouped model would be::
 
             class Grouped(RankedModel):
                 group_number = models.IntegerField()
 
-                def grouped_filter(self):
-                    return Grouped.objects.filter(
-                        group_number=self.group_number)
+                rank_group_fields = ('group_number', )
+
+        This method can still be overridden for groupings that can't be
+        expressed as field values, but awl can't introspect the result: the
+        whole filtered ``QuerySet`` is then locked when ranks change.
 
         :returns:
             :class:`QuerySet` of ``RankedModel`` objects that are in the same
             group.
         """
-        return self.__class__.objects.all()
+        return self.__class__.objects.filter(**self._group_values())
+
+    def _group_values(self):
+        # maps the column attribute of each group field to its value, run
+        # through the field so that e.g. team_id='1' and 1 are the same group
+        values = {}
+        for name in self.rank_group_fields:
+            field = self._meta.get_field(name)
+            values[field.attname] = field.to_python(getattr(self, 
+                field.attname))
+
+        return values
+
+    def _group_items(self, values=None):
+        # objects in the group with the given values, defaults to this
+        # object's group
+        if values is None or not self.rank_group_fields:
+            return self.grouped_filter()
+
+        return self.__class__.objects.filter(**values)
+
+    def _group_key(self, values=None):
+        # identifies a group, defaulting to the one this object belongs to:
+        # objects with the same key share the same grouped_filter()
+        if self.rank_group_fields:
+            if values is None:
+                values = self._group_values()
+
+            return tuple(values.values())
+
+        return str(self.grouped_filter().query)
 
     def repack(self):
-        """Removes any blank ranks in the order."""
-        items = self.grouped_filter().order_by('rank').select_for_update()
-        for count, item in enumerate(items):
-            item.rank = count + 1
-            item.save(rerank=False)
+        """Removes any blank ranks in the order.  Only the objects whose rank
+        changes are written, using a single bulk update.  Groups whose rank
+        is derived from other fields, like :class:`ScoreRankedModel`, are
+        put back in their derived order."""
+        self._repack()
+
+    @_rank_operation
+    def _repack(self, low=None, high=None):
+        # repacks the group, low and high give the range of ranks of any
+        # objects just removed from it, which are included in the signal
+        self._lock_group()
+        ordering = self._derived_ordering() or ['rank', 'pk']
+        items = self.grouped_filter().order_by(*ordering).only('pk', 'rank')
+
+        changed = []
+        for count, item in enumerate(items, start=1):
+            if item.pk == self.pk:
+                self.rank = count
+                self._rank_at_load = count
+
+            if item.rank != count:
+                item.rank = count
+                changed.append(item)
+
+        self.__class__.objects.bulk_update(changed, ['rank'])
+
+        if changed:
+            low = changed[0].rank if low is None else min(low, 
+                changed[0].rank)
+            high = max(high or 0, changed[-1].rank)
+
+        if low is not None:
+            self._ranks_changed(low, high)
+
+
+# ============================================================================
+
+class ScoreRankedModel(RankedModel):
+    """Abstract :class:`RankedModel` for leaderboards, where the rank follows
+    a numeric score instead of being set directly.  Inheritors declare the
+    score field and name it in ``rank_score_field``::
+
+        class Player(ScoreRankedModel):
+            league = models.ForeignKey(League, on_delete=models.CASCADE)
+            points = models.IntegerField()
+
+            rank_group_fields = ('league', )
+            rank_score_field = 'points'
+
+    On save the object's position is found by counting the objects in the
+    group with a better score, served by an automatically added composite
+    index on the group fields plus the score.  A score change then moves
+    the object with a single shift of the ranks between its old and new
+    positions rather than re-ranking the whole group.  Ties are broken by
+    primary key, a new object goes after any existing objects with the same
+    score.
+
+    Any rank set directly is replaced by the one derived from the score and
+    the relative move methods raise ``TypeError``.  Scores must not be
+    null.
+    """
+    #: Name of the field the rank is derived from
+    rank_score_field = 'score'
+
+    #: True if a higher score ranks first
+    rank_score_descending = True
+
+    class Meta(RankedModel.Meta):
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super(ScoreRankedModel, self).__init__(*args, **kwargs)
+        self._score_at_load = self.__dict__.get(self._score_attname())
+
+    def _score_attname(self):
+        return self._meta.get_field(self.rank_score_field).attname
+
+    def _rank_changed(self):
+        return self.rank != self._rank_at_load or \
+            getattr(self, self._score_attname()) != self._score_at_load
+
+    def _derived_rank(self):
+        # one more than the number of objects ahead of this one
+        name = self.rank_score_field
+        score = getattr(self, self._score_attname())
+        lookup = '%s__%s' % (name, 'gt' if self.rank_score_descending else
+            'lt')
+
+        ahead = Q(**{lookup:score})
+        if self.pk is None:
+            ahead |= Q(**{name:score})
+        else:
+            ahead |= Q(**{name:score, 'pk__lt':self.pk})
+
+        return self.grouped_filter().exclude(pk=self.pk).filter(
+            ahead).count() + 1
+
+    def _derived_ordering(self):
+        prefix = '-' if self.rank_score_descending else ''
+        return [prefix + self.rank_score_field, 'pk']
+
+    def _check_movable(self, *objs):
+        raise TypeError('%s ranks are derived from %s and can not be moved' %
+            (self._meta.label, self.rank_score_field))
+
+    def save(self, *args, **kwargs):
+        """Overridden method that sets the rank from the score, see
+        :class:`RankedModel.save` for details."""
+        super(ScoreRankedModel, self).save(*args, **kwargs)
+        self._score_at_load = getattr(self, self._score_attname())
+
+
+def _lock_id(text):
+    # converts text into a signed 32-bit integer for use as an advisory lock
+    # key
+    value = zlib.crc32(text.encode('utf-8'))
+    if value >= 2 ** 31:
+        value -= 2 ** 32
+
+    return value
+
+
+def _add_index(model, fields):
+    for index in model._meta.indexes:
+        if list(index.fields) == fields:
+            # index declared explicitly, nothing to do
+            return
+
+    # class_prepared fires after Django names the declared indexes, so the
+    # generated one has to be named here
+    index = models.Index(fields=fields)
+    index.set_name_with_model(model)
+    model._meta.indexes.append(index)
+
+
+def _add_rank_index(sender, **kwargs):
+    # adds a composite index on the group fields plus rank to each concrete
+    # RankedModel that declares rank_group_fields, and one on the group
+    # fields plus score to each ScoreRankedModel
+    if not issubclass(sender, RankedModel) or sender._meta.abstract or \
+            sender._meta.proxy:
+        return
+
+    if sender.rank_group_fields:
+        _add_index(sender, list(sender.rank_group_fields) + ['rank'])
+
+    if issubclass(sender, ScoreRankedModel):
+        prefix = '-' if sender.rank_score_descending else ''
+        _add_index(sender, list(sender.rank_group_fields) + [
+            prefix + sender.rank_score_field])
+
+class_prepared.connect(_add_rank_index)
@@ -0,0 +1,19 @@
+# awl.rankedmodel.signals.py
+from django.dispatch import Signal
+
+# ============================================================================
+
+#: Sent once for each group whose ranks were changed by a
+#: :class:`awl.rankedmodel.models.RankedModel` operation, after the
+#: transaction making the change commits.  Nothing is sent if the
+#: transaction rolls back.  Receivers get the following arguments:
+#:
+#: * ``sender``: the ``RankedModel`` class
+#: * ``group``: the group's key, a tuple of the ``rank_group_fields`` values
+#:   (or a string identifying the query for an overridden
+#:   ``grouped_filter()``)
+#: * ``values``: dict mapping the column of each group field to its value
+#: * ``low``, ``high``: the inclusive range of ranks that changed, anything
+#:   outside of it kept its place
+#: * ``using``: the database alias
+ranks_changed = Signal()
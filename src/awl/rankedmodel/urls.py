@@ -4,4 +4,6 @@ from awl.rankedmodel import views
 urlpatterns = [
     path('move/<int:content_type_id>/<int:obj_id>/<int:rank>/', views.move, 
         name='awl-rankedmodel-move'),
+    path('reorder/<int:content_type_id>/', views.reorder, 
+        name='awl-rankedmodel-reorder'),
 ]
@@ -1,9 +1,14 @@
 # awl.rankedmodel.views.py
 
+from django.contrib.auth import get_permission_codename
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+
+from awl.decorators import json_post_required
+from awl.rankedmodel.models import RankedModel, ScoreRankedModel
 
 # ============================================================================
 
@@ -25,7 +30,95 @@ def move(request, content_type_id, obj_id, rank):
     """
     content_type = ContentType.objects.get_for_id(content_type_id)
     obj = get_object_or_404(content_type.model_class(), id=obj_id)
-    obj.rank = int(rank)
-    obj.save()
+    obj.move_to(int(rank))
 
     return HttpResponseRedirect(request.META['HTTP_REFERER'])
+
+
+@staff_member_required
+@json_post_required('data', 'json_data')
+def reorder(request, content_type_id):
+    """View for re-ordering many :class:`RankedModel` objects at once, used
+    by the drag and drop admin script (see :func:`admin_reorder_handle`).
+    Expects a POST with a ``data`` field containing a JSON dictionary with
+    either a list of moves, applied in order::
+
+        {"moves": [{"id": 3, "rank": 1}, {"id": 7, "rank": 4}]}
+
+    or the full ordering of a group by object id::
+
+        {"order": [7, 3, 12, 4]}
+
+    Objects in a full ordering are given ranks 1 to N in the order listed,
+    any objects in the group that aren't listed follow them.  All changes
+    are made in a single transaction using :class:`RankedModel.batch`.  The
+    user needs the model's "change" permission.  The ranks of a
+    :class:`ScoreRankedModel` can't be set and are refused.
+
+    :param content_type_id:
+        ``ContentType`` id of the objects being moved
+    :returns:
+        ``JsonResponse`` with a ``ranks`` dictionary mapping the id of each
+        object whose rank changed to its new rank
+    """
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    model = content_type.model_class()
+    if model is None or not issubclass(model, RankedModel):
+        raise Http404('Not a RankedModel')
+
+    if issubclass(model, ScoreRankedModel):
+        return JsonResponse({'error':'Ranks of %s are derived from %s' % (
+            model._meta.label, model.rank_score_field)}, status=400)
+
+    opts = model._meta
+    permission = '%s.%s' % (opts.app_label, get_permission_codename('change',
+        opts))
+    if not request.user.has_perm(permission):
+        return JsonResponse({'error':'Permission denied'}, status=403)
+
+    data = request.json_data
+    try:
+        if 'order' in data:
+            moves = [(pk, rank) for rank, pk in enumerate(data['order'], 
+                start=1)]
+        else:
+            moves = [(move['id'], int(move['rank'])) for move in 
+                data['moves']]
+
+        moves = [(model._meta.pk.to_python(pk), rank) for pk, rank in moves]
+    except (KeyError, TypeError, ValueError, ValidationError):
+        return JsonResponse({'error':'Expected "moves" or "order"'}, 
+            status=400)
+
+    with model.batch():
+        objs = model._default_manager.in_bulk([pk for pk, rank in moves])
+        if len(objs) != len(set(pk for pk, rank in moves)):
+            raise Http404('Object not found')
+
+        # ranks can only change between the old and new positions of the
+        # moved objects, that range of each group is read before and after
+        # the moves to find the ones that did
+        groups = {}
+        for pk, rank in moves:
+            obj = objs[pk]
+            first, low, high = groups.get(obj._group_key(), (obj, obj.rank,
+                obj.rank))
+            groups[obj._group_key()] = (first, min(low, obj.rank, rank), 
+                max(high, obj.rank, rank))
+
+        before = {}
+        for obj, low, high in groups.values():
+            before.update(obj.grouped_filter().filter(rank__gte=low,
+                rank__lte=high).values_list('pk', 'rank'))
+
+        for pk, rank in moves:
+            objs[pk].move_to(rank)
+
+    ranks = {}
+    for obj, low, high in groups.values():
+        for pk, rank in obj.grouped_filter().filter(rank__gte=low,
+                rank__lte=high).values_list('pk', 'rank'):
+            if before.get(pk) != rank:
+                ranks[str(pk)] = rank
+
+    return JsonResponse({'ranks':ranks})
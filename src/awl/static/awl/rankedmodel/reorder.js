@@ -0,0 +1,126 @@
+// awl/rankedmodel/reorder.js
+//
+// Drag and drop re-ordering for the django admin change list.  Rows
+// containing an awl.rankedmodel.admintools.admin_reorder_handle() can be
+// dragged onto another row in the same group, the dragged object takes the
+// rank of the row it was dropped on.  Each drop is POSTed to the handle's
+// reorder view and the returned ranks of the objects that moved are used
+// to update the handles and re-sort the rows of the group.
+(function() {
+    'use strict';
+
+    function getCookie(name) {
+        var cookies = document.cookie ? document.cookie.split(';') : [];
+        for (var i = 0; i < cookies.length; i++) {
+            var cookie = cookies[i].trim();
+            if (cookie.substring(0, name.length + 1) === (name + '=')) {
+                return decodeURIComponent(cookie.substring(name.length + 1));
+            }
+        }
+        return null;
+    }
+
+    function sendMoves(url, moves, onDone) {
+        var body = new URLSearchParams();
+        body.append('data', JSON.stringify({moves: moves}));
+
+        var request = new XMLHttpRequest();
+        request.open('POST', url);
+        request.setRequestHeader('X-CSRFToken', getCookie('csrftoken'));
+        request.setRequestHeader('Content-Type',
+            'application/x-www-form-urlencoded');
+        request.onload = function() {
+            if (request.status === 200) {
+                onDone(JSON.parse(request.responseText).ranks);
+            } else {
+                window.alert('Re-ordering failed: ' + request.status);
+            }
+        };
+        request.send(body.toString());
+    }
+
+    function applyRanks(tbody, group, ranks) {
+        // only the rows of the dropped row's group are re-sorted, they take
+        // over the positions the group already had so other groups shown
+        // in the same table stay where they are
+        var rows = Array.prototype.slice.call(tbody.rows);
+        var slots = [];
+        var members = [];
+        rows.forEach(function(row, index) {
+            var handle = row.querySelector('.awl-rank-handle');
+            if (!handle || handle.dataset.group !== group) {
+                return;
+            }
+
+            if (ranks[handle.dataset.id] !== undefined) {
+                handle.dataset.rank = ranks[handle.dataset.id];
+            }
+            slots.push(index);
+            members.push(row);
+        });
+
+        members.sort(function(a, b) {
+            var handleA = a.querySelector('.awl-rank-handle');
+            var handleB = b.querySelector('.awl-rank-handle');
+            return Number(handleA.dataset.rank) -
+                Number(handleB.dataset.rank);
+        });
+        slots.forEach(function(slot, i) {
+            rows[slot] = members[i];
+        });
+        rows.forEach(function(row) {
+            tbody.appendChild(row);
+        });
+    }
+
+    function init() {
+        var handles = document.querySelectorAll('.awl-rank-handle');
+        var dragged = null;
+
+        Array.prototype.forEach.call(handles, function(handle) {
+            var row = handle.closest('tr');
+            row.setAttribute('draggable', 'true');
+
+            row.addEventListener('dragstart', function(event) {
+                dragged = handle;
+                event.dataTransfer.effectAllowed = 'move';
+                event.dataTransfer.setData('text/plain', handle.dataset.id);
+            });
+
+            row.addEventListener('dragover', function(event) {
+                if (dragged &&
+                        dragged.dataset.group === handle.dataset.group) {
+                    event.preventDefault();
+                }
+            });
+
+            row.addEventListener('drop', function(event) {
+                event.preventDefault();
+                if (!dragged || dragged === handle) {
+                    return;
+                }
+
+                if (dragged.dataset.group !== handle.dataset.group) {
+                    // ranks are only meaningful within a group
+                    dragged = null;
+                    return;
+                }
+
+                var moves = [{
+                    id: dragged.dataset.id,
+                    rank: Number(handle.dataset.rank)
+                }];
+                dragged = null;
+                sendMoves(handle.dataset.url, moves, function(ranks) {
+                    applyRanks(row.parentNode, handle.dataset.group, ranks);
+                });
+            });
+        });
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', init);
+    } else {
+        init();
+    }
+})();
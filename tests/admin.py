@@ -4,7 +4,8 @@ from awl.admintools import make_admin_obj_mixin, fancy_modeladmin
 from tests.models import (Link, Author, Book, Chapter, Driver,
     VehicleMake, VehicleModel, Dealer)
 from awl.rankedmodel.admintools import (admin_link_move_up,
-    admin_link_move_down, admin_move_links)
+    admin_link_move_down, admin_move_links, admin_reorder_handle,
+    RankedModelAdminMixin)
 
 # ============================================================================
 # Waelsteng Admin Models
@@ -96,8 +97,11 @@ class DealerAdmin(base):
 # RankedModel Admin Models
 # ============================================================================
 
-class RankAdmin(admin.ModelAdmin):
-    list_display = ('name', 'move_up', 'move_down', 'move_both')
+class RankAdmin(RankedModelAdminMixin, admin.ModelAdmin):
+    list_display = ('name', 'move_up', 'move_down', 'move_both', 'handle')
+
+    class Media:
+        js = ('awl/rankedmodel/reorder.js', )
 
     def move_up(self, obj):
         return admin_link_move_up(obj)
@@ -110,3 +114,6 @@ class RankAdmin(admin.ModelAdmin):
     def move_both(self, obj):
         return admin_move_links(obj)
     move_both.short_description = 'Move Both'
+
+    def handle(self, obj):
+        return admin_reorder_handle(obj)
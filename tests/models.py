@@ -1,7 +1,7 @@
 from django.db import models
 
 from awl.absmodels import ValidatingMixin
-from awl.rankedmodel.models import RankedModel
+from awl.rankedmodel.models import RankedModel, ScoreRankedModel
 
 # ============================================================================
 # Waelsteng Models
@@ -99,9 +99,56 @@ class Grouped(RankedModel):
     group = models.CharField(max_length=1)
     name = models.CharField(max_length=1)
 
+    rank_group_fields = ('group', )
+
     def grouped_filter(self):
         return Grouped.objects.filter(group=self.group)
 
+
+class Filtered(RankedModel):
+    # groups only through the grouped_filter() override
+    group = models.CharField(max_length=1)
+    name = models.CharField(max_length=1)
+
+    def grouped_filter(self):
+        return Filtered.objects.filter(group=self.group)
+
+
+class Wide(RankedModel):
+    rank = models.PositiveIntegerField()
+    group = models.CharField(max_length=1)
+    name = models.CharField(max_length=1)
+
+    rank_group_fields = ('group', )
+
+
+class Team(models.Model):
+    name = models.CharField(max_length=1)
+
+
+class Player(RankedModel):
+    team = models.ForeignKey(Team, on_delete=models.CASCADE)
+    name = models.CharField(max_length=1)
+
+    rank_group_fields = ('team', )
+
+
+class Optimist(RankedModel):
+    group = models.CharField(max_length=1)
+    name = models.CharField(max_length=1)
+
+    rank_group_fields = ('group', )
+    rank_optimistic = True
+
+
+class Leader(ScoreRankedModel):
+    group = models.CharField(max_length=1)
+    name = models.CharField(max_length=1)
+    points = models.IntegerField()
+
+    rank_group_fields = ('group', )
+    rank_score_field = 'points'
+
 # ============================================================================
 # get_field_names() models
 
@@ -1,5 +1,6 @@
 # tests.test_commands.py
 import os
+from io import StringIO
 from unittest import mock
 
 from django.conf import settings
@@ -53,6 +54,88 @@ class CommandTests(TestCase):
 
             self.assertEqual(capture.getvalue(), 'three four\n')
 
+    def test_audit_ranks(self):
+        from tests.models import Alone, Grouped, Team, Player
+
+        for name in 'abc':
+            Alone.objects.create(name=name)
+            Grouped.objects.create(name=name, group='x')
+            Grouped.objects.create(name=name, group='y')
+
+        team = Team.objects.create(name='t')
+        for name in 'abcd':
+            Player.objects.create(name=name, team=team)
+
+        # nothing broken yet
+        out = StringIO()
+        call_command('audit_ranks', 'tests.Grouped', 'tests.Player', 
+            stdout=out)
+        self.assertIn('tests.Grouped: 0 broken groups', out.getvalue())
+        self.assertIn('tests.Player: 0 broken groups', out.getvalue())
+
+        # break the ranks behind RankedModel's back
+        Alone.objects.filter(name='a').update(rank=0)
+        Grouped.objects.filter(name='b', group='y').update(rank=1)
+        Grouped.objects.filter(name='c', group='x').update(rank=7)
+        Player.objects.filter(name__in=['c', 'd']).update(rank=9)
+
+        out = StringIO()
+        call_command('audit_ranks', stdout=out)
+        output = out.getvalue()
+        self.assertIn('tests.Alone: 1 broken groups', output)
+        self.assertIn('tests.Grouped: 2 broken groups', output)
+        self.assertIn('tests.Player: 1 broken groups', output)
+        self.assertIn('tests.Filtered: skipped', output)
+        self.assertIn('1 duplicates', output)
+
+        # dry run changed nothing
+        self.assertEqual(9, Player.objects.get(name='d').rank)
+
+        out = StringIO()
+        call_command('audit_ranks', '--repair', '--chunk-size', '1',
+            stdout=out)
+        self.assertIn('tests.Grouped: 2 groups repaired', out.getvalue())
+
+        self.assertEqual([1, 2, 3], list(Alone.objects.values_list('rank',
+            flat=True)))
+        for group in 'xy':
+            self.assertEqual([1, 2, 3], list(Grouped.objects.filter(
+                group=group).values_list('rank', flat=True)))
+
+        self.assertEqual('abcd', ''.join(Player.objects.values_list('name',
+            flat=True)))
+        self.assertEqual([1, 2, 3, 4], list(Player.objects.values_list('rank',
+            flat=True)))
+
+        out = StringIO()
+        call_command('audit_ranks', stdout=out)
+        self.assertNotIn(' 1 broken', out.getvalue())
+        self.assertNotIn(' 2 broken', out.getvalue())
+
+        # bad labels
+        with self.assertRaises(CommandError):
+            call_command('audit_ranks', 'tests.Nope')
+
+        with self.assertRaises(CommandError):
+            call_command('audit_ranks', 'tests.Team')
+
+    def test_audit_ranks_scores(self):
+        from tests.models import Leader
+
+        for name, points in [('a', 10), ('b', 30), ('c', 20)]:
+            Leader.objects.create(name=name, group='y', points=points)
+
+        # a broken leaderboard is repaired back into score order
+        Leader.objects.filter(name__in=['a', 'c']).update(rank=1)
+        out = StringIO()
+        call_command('audit_ranks', 'tests.Leader', '--repair', stdout=out)
+        self.assertIn('tests.Leader: 1 groups repaired', out.getvalue())
+
+        self.assertEqual('bca', ''.join(Leader.objects.values_list('name',
+            flat=True)))
+        self.assertEqual([1, 2, 3], list(Leader.objects.values_list('rank',
+            flat=True)))
+
     def test_create_cmd(self):
         with temp_directory(path=settings.BASE_DIR) as td:
             app_name = os.path.basename(td)
@@ -1,8 +1,50 @@
 # tests.test_models.py
-from django.test import TestCase
+import base64
+import json
 
-from awl.models import Counter, Lock, Choices, QuerySetChain
+import django
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User, Group
+from django.db import connection, NotSupportedError
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from unittest import mock, skipIf
+
+from awl.models import (Counter, Lock, Choices, QuerySetChain, 
+    _estimated_count)
 from awl.utils import refetch
+from tests.models import Author, Book, Chapter
+
+# ============================================================================
+
+def seed_people(count=5):
+    # "count" each of users, groups and authors, named u0, g0, a0 onwards
+    for number in range(count):
+        User.objects.create(username='u%s' % number)
+        Group.objects.create(name='g%s' % number)
+        Author.objects.create(name='a%s' % number)
+
+
+def seed_shelf():
+    # authors and books whose names interleave: a, c, e, g and b, d, f
+    for name in 'aceg':
+        Author.objects.create(name=name)
+
+    for name in 'bdf':
+        Book.objects.create(name=name)
+
+
+def names(items):
+    # names of objects (usernames for users) or of values() records
+    return [item['name'] if isinstance(item, dict) else 
+        getattr(item, 'username', None) or item.name for item in items]
+
+
+def letters(items):
+    # single letter names joined into a string
+    return ''.join(names(items))
 
 # ============================================================================
 
@@ -47,7 +89,6 @@ class ModelsTest(TestCase):
 
     def test_queryset_chain(self):
         # create some object to query
-        from django.contrib.auth.models import User, Group
         User.objects.create(username='u1')
         User.objects.create(username='u2')
         User.objects.create(username='u3')
@@ -70,3 +111,421 @@ class ModelsTest(TestCase):
 
         # trigger internal _clone(), make sure it doesn't blow up
         chain._clone()
+
+    def test_queryset_chain_slicing(self):
+        seed_people()
+
+        chain = QuerySetChain(User.objects.order_by('id'), 
+            Group.objects.order_by('id'), Author.objects.order_by('id'))
+
+        self.assertEqual(['u3', 'u4', 'g0', 'g1'], names(chain[3:7]))
+        self.assertEqual(['a3', 'a4'], names(chain[13:20]))
+        self.assertEqual(['u0', 'u2', 'u4', 'g1'], names(chain[0:8:2]))
+        self.assertEqual(15, len(chain[:]))
+        self.assertEqual('g2', chain[7].name)
+
+        # counts are cached, each page only queries the subquerysets it
+        # covers
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(['g4', 'a0'], names(chain[9:11]))
+
+        self.assertEqual(2, len(context.captured_queries))
+
+        with self.assertRaises(IndexError):
+            chain[15]
+
+        with self.assertRaises(ValueError):
+            chain[-1]
+
+    def test_queryset_chain_counts(self):
+        seed_people()
+
+        chain = QuerySetChain(User.objects.order_by('id'), 
+            Group.objects.order_by('id'), Author.objects.order_by('id'))
+
+        # slicing without counting, the short read of users gives their
+        # count
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(4, len(chain[3:7]))
+
+        self.assertEqual(2, len(context.captured_queries))
+        for query in context.captured_queries:
+            self.assertNotIn('COUNT', query['sql'])
+
+        # groups and authors still need counting, once
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(15, chain.count())
+            self.assertEqual(15, chain.count())
+            self.assertEqual(15, len(chain))
+
+        self.assertEqual(2, len(context.captured_queries))
+
+        # slicing past the end of an uncounted subqueryset counts it
+        chain = QuerySetChain(User.objects.order_by('id'), 
+            Group.objects.order_by('id'))
+        self.assertEqual('g2', chain[7].name)
+        self.assertEqual([], chain[10:12])
+        self.assertEqual(10, len(chain))
+
+    def test_queryset_chain_merge(self):
+        seed_shelf()
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        merged = chain.order_by('name')
+        self.assertEqual((), chain.ordering)
+        self.assertEqual(('name', ), merged._clone().ordering)
+
+        # a page reads at most a page of records from each subqueryset
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual('ab', letters(merged[:2]))
+
+        self.assertEqual(2, len(context.captured_queries))
+        for query in context.captured_queries:
+            self.assertIn('LIMIT 2', query['sql'])
+
+        self.assertEqual('cde', letters(merged[2:5]))
+        self.assertEqual('d', merged[3].name)
+        self.assertEqual('gfedcba', letters(chain.order_by('-name')[:]))
+        self.assertEqual(7, merged.count())
+
+        # iteration reads in chunks
+        merged.merge_chunk_size = 2
+        self.assertEqual('abcdefg', letters(merged._all()))
+
+        # values() records and mixed directions
+        Book.objects.create(name='b')
+        chain = QuerySetChain(Author.objects.values('name', 'id'), 
+            Book.objects.values('name', 'id')).order_by('name', '-id')
+        self.assertEqual(['a', 'b', 'b', 'c'], [item['name'] 
+            for item in chain[:4]])
+        first, second = chain[1:3]
+        self.assertGreater(first['id'], second['id'])
+
+        # values_list() records are read by column position
+        chain = QuerySetChain(Author.objects.values_list('name', 'id'),
+            Book.objects.values_list('id', 'name')).order_by('name', 'id')
+        self.assertEqual([('a', 1), (1, 'b'), (4, 'b')], chain[:3])
+        records, cursor = chain.cursor_page(size=2)
+        self.assertEqual([(4, 'b'), ('c', 2)], chain.cursor_page(cursor,
+            size=2)[0])
+
+        chain = QuerySetChain(Author.objects.values_list('name', flat=True),
+            Book.objects.values_list('name', flat=True)).order_by('-name')
+        self.assertEqual('gfedcbba', ''.join(chain._all()))
+
+        with self.assertRaises(ValueError):
+            QuerySetChain(Author.objects.values_list('id')).order_by('name')
+
+        # nulls are placed by the database the way the merge expects
+        chain = QuerySetChain(Book.objects.all()).order_by('author', '-id')
+        sql = str(chain.querysets[0].query)
+        self.assertIn('NULLS FIRST', sql)
+        self.assertIn('NULLS LAST', sql)
+
+        Book.objects.filter(name='d').update(author=Author.objects.first())
+        self.assertEqual('bfbd', letters(QuerySetChain(
+            Book.objects.all()).order_by('author', '-id')[:]))
+        self.assertEqual('dbfb', letters(QuerySetChain(
+            Book.objects.all()).order_by('-author', '-id')[:]))
+
+    def test_queryset_chain_cursor(self):
+        seed_shelf()
+
+        def pages(chain, size, **kwargs):
+            results = []
+            records, cursor = chain.cursor_page(size=size, **kwargs)
+            results.append(letters(records))
+            while cursor:
+                with CaptureQueriesContext(connection) as context:
+                    records, cursor = chain.cursor_page(cursor, size=size, 
+                        **kwargs)
+
+                for query in context.captured_queries:
+                    self.assertNotIn('COUNT', query['sql'])
+                    self.assertNotIn('OFFSET', query['sql'])
+
+                results.append(letters(records))
+
+            return results
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        self.assertEqual(['ace', 'gbd', 'f'], pages(chain, 3))
+        self.assertEqual(['ac', 'eg', 'bd', 'f'], pages(chain, 2))
+        self.assertEqual(['gec', 'afd', 'b'], pages(chain, 3, 
+            fields=('-name', )))
+
+        merged = chain.order_by('name', 'id')
+        self.assertEqual(['abc', 'def', 'g'], pages(merged, 3))
+
+        # rows inserted before the cursor don't shift the next page, equal
+        # keys in different subquerysets are kept
+        records, cursor = merged.cursor_page(size=2)
+        Author.objects.create(name='a')
+        Book.objects.create(name='c')
+        records, cursor = merged.cursor_page(cursor, size=3)
+        self.assertEqual('ccd', letters(records))
+
+        with self.assertRaises(ValueError):
+            merged.cursor_page('garbage')
+
+        # cursors that decode to the wrong shape are refused the same way
+        for bad in [7, [0], ['0', ['a', 1]], [0, 'a'], [True, ['a', 1]],
+                [2, ['a', 1]], [0, ['a']]]:
+            cursor = base64.urlsafe_b64encode(json.dumps(bad).encode(
+                'utf-8')).decode('ascii')
+            with self.assertRaises(ValueError):
+                merged.cursor_page(cursor)
+
+    def test_queryset_chain_union(self):
+        seed_shelf()
+
+        authors = Author.objects.order_by().values('name')
+        books = Book.objects.order_by().values('name')
+        chain = QuerySetChain(authors, books).union_all()
+        self.assertTrue(chain._clone().union)
+
+        # counting and slicing are single queries
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(7, chain.count())
+            self.assertEqual(7, len(chain))
+            self.assertEqual('egb', letters(chain[2:5]))
+            self.assertEqual({'name':'e'}, chain[2])
+
+        self.assertEqual(3, len(context.captured_queries))
+        self.assertIn('UNION ALL', context.captured_queries[1]['sql'])
+        self.assertEqual('acegbdf', letters(chain._all()))
+
+        merged = QuerySetChain(authors, books).order_by('-name').union_all()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual('fed', letters(merged[1:4]))
+
+        self.assertEqual(1, len(context.captured_queries))
+
+        tuples = QuerySetChain(Author.objects.order_by().values_list('name',
+            'id'), Book.objects.order_by().values_list('name', 'id'))
+        self.assertEqual([('g', 4), ('b', 1)], tuples.union_all()[3:5])
+
+        # incompatible chains fall back to querying each subqueryset
+        for chain in [
+                QuerySetChain(authors, Book.objects.all()).union_all(),
+                QuerySetChain(authors, Book.objects.values_list('name', 
+                    flat=True)).union_all(),
+                QuerySetChain(authors, Book.objects.order_by().values('name',
+                    'id')).union_all(),
+            ]:
+            self.assertIsNone(chain._union_queryset())
+
+        # merged values() chains need the ordering amongst the values
+        with self.assertRaises(ValueError):
+            QuerySetChain(authors, books).order_by('id')
+
+        chain = QuerySetChain(authors, books.order_by('name')).union_all()
+        self.assertEqual('acegbdf', letters(chain[:]))
+
+        # records within each subqueryset are ordered by their columns so
+        # pages are stable
+        Author.objects.create(name='b')
+        chain = QuerySetChain(authors, books).union_all()
+        self.assertEqual('abc', letters(chain[:3]))
+        self.assertEqual('egb', letters(chain[3:6]))
+
+    def test_queryset_chain_iterator(self):
+        seed_shelf()
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        records = chain.iterator(chunk_size=2)
+        self.assertEqual('acegbdf', letters(records))
+
+        # nothing is cached on the subquerysets
+        for qs in chain.querysets:
+            self.assertIsNone(qs._result_cache)
+
+        merged = chain.order_by('-name')
+        self.assertEqual('gfedcba', letters(merged.iterator(chunk_size=2)))
+
+        union = QuerySetChain(Author.objects.order_by().values('name'), 
+            Book.objects.order_by().values('name')).union_all()
+        self.assertEqual('acegbdf', letters(union.iterator()))
+
+    def test_queryset_chain_estimated(self):
+        seed_people(3)
+
+        chain = QuerySetChain(User.objects.all(), Author.objects.all())
+
+        # no estimates from sqlite, counts are exact
+        estimated = chain.estimated(threshold=1)
+        self.assertEqual(1, estimated._clone().estimate_threshold)
+        self.assertEqual(6, estimated.count())
+        self.assertFalse(estimated.is_estimate)
+
+        def fake_estimate(qs):
+            return 50000 if qs.model is User else 2
+
+        with mock.patch('awl.models._estimated_count', fake_estimate):
+            estimated = chain.estimated()
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(50003, estimated.count())
+
+            # only the small subqueryset was counted
+            self.assertEqual(1, len(context.captured_queries))
+            self.assertTrue(estimated.is_estimate)
+
+            # exact counts found by slicing are used over estimates
+            self.assertEqual(6, len(estimated[:10]))
+            self.assertEqual(6, estimated.count())
+            self.assertFalse(estimated.is_estimate)
+
+    def test_estimated_count(self):
+        class FakeCursor:
+            def __init__(self, rows):
+                self.rows = rows
+                self.executed = []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql, params=None):
+                self.executed.append(sql)
+
+            def fetchone(self):
+                return self.rows.pop(0)
+
+        def estimate(qs, rows):
+            cursor = FakeCursor(rows)
+            fake = mock.Mock(vendor='postgresql')
+            fake.cursor.return_value = cursor
+            fake.ops.quote_name = lambda name: '"%s"' % name
+            with mock.patch('awl.models.connections', {'default':fake}):
+                return _estimated_count(qs), cursor.executed
+
+        plan = [{'Plan':{'Node Type':'Seq Scan', 'Plan Rows':42}}]
+
+        # whole tables use the table's row estimate
+        count, executed = estimate(Author.objects.all(), [(1234.0, )])
+        self.assertEqual(1234, count)
+        self.assertEqual(1, len(executed))
+        self.assertIn('reltuples', executed[0])
+
+        # filtered querysets and unanalyzed tables ask the planner, whose
+        # JSON may come back decoded or as text
+        count, executed = estimate(Author.objects.filter(name='a'), 
+            [(plan, )])
+        self.assertEqual(42, count)
+        self.assertEqual(1, len(executed))
+        self.assertTrue(executed[0].startswith('EXPLAIN (FORMAT JSON) '))
+        self.assertIn('WHERE', executed[0])
+
+        count, executed = estimate(Author.objects.all(), [(-1.0, ), 
+            (json.dumps(plan), )])
+        self.assertEqual(42, count)
+        self.assertEqual(2, len(executed))
+
+    @skipIf(django.VERSION < (4, 1), 'async querysets need Django 4.1')
+    async def test_queryset_chain_async(self):
+        await sync_to_async(seed_shelf)()
+
+        chain = QuerySetChain(Author.objects.order_by('id'), 
+            Book.objects.order_by('id'))
+        self.assertEqual(7, await chain.acount())
+        self.assertEqual('acegbdf', letters([item async for item in chain]))
+        self.assertEqual('egb', letters(await chain.agetitem(slice(2, 5))))
+        self.assertEqual('d', (await chain.agetitem(5)).name)
+        with self.assertRaises(IndexError):
+            await chain.agetitem(7)
+
+        merged = chain.order_by('-name')
+        merged.merge_chunk_size = 2
+        self.assertEqual('gfedcba', letters([item async for item in merged]))
+        self.assertEqual('fed', letters(await merged.agetitem(slice(1, 4))))
+        self.assertEqual('cba', letters(await merged.agetitem(slice(4, None))))
+
+        union = QuerySetChain(Author.objects.order_by().values('name'), 
+            Book.objects.order_by().values('name')).union_all()
+        self.assertEqual(7, await union.acount())
+        self.assertEqual('acegbdf', letters([item async for item in union]))
+        self.assertEqual('gb', letters(await union.agetitem(slice(3, 5))))
+
+        # prefetching subquerysets are read a slice at a time, as Django
+        # 4.1 and 4.2 refuse them in aiterator()
+        original = QuerySet.aiterator
+        def aiterator(qs, *args, **kwargs):
+            if qs._prefetch_related_lookups:
+                raise NotSupportedError('prefetch_related() in aiterator()')
+
+            return original(qs, *args, **kwargs)
+
+        chain = QuerySetChain(Author.objects.prefetch_related(
+            'book_set').order_by('id'), Book.objects.order_by('id'))
+        with mock.patch.object(QuerySet, 'aiterator', aiterator):
+            records = [item async for item in chain]
+
+        self.assertEqual('acegbdf', letters(records))
+        self.assertIn('book_set', records[0]._prefetched_objects_cache)
+
+    def test_queryset_chain_related(self):
+        from django.db.models import Prefetch
+        for name in 'ab':
+            author = Author.objects.create(name=name)
+            for count in range(3):
+                book = Book.objects.create(name=name, author=author)
+                Chapter.objects.create(name=name, book=book)
+
+        chain = QuerySetChain(Book.objects.order_by('id'), 
+            Chapter.objects.order_by('id'))
+        related = chain.select_related({Book:['author'], 
+            'tests.Chapter':['book__author']})
+
+        with CaptureQueriesContext(connection) as context:
+            records = related[4:9]
+            authors = [getattr(record, 'author', None) or 
+                record.book.author for record in records]
+
+        # one query per subqueryset in the slice, none per object
+        self.assertEqual(2, len(context.captured_queries))
+        self.assertEqual(['b', 'b', 'a', 'a', 'a'], names(authors))
+
+        chain = QuerySetChain(Author.objects.order_by('id'), 
+            Book.objects.order_by('id'))
+        related = chain.prefetch_related({Author:[Prefetch('book_set', 
+            queryset=Book.objects.order_by('id'))]})
+        with CaptureQueriesContext(connection) as context:
+            records = related[:3]
+            counts = [len(record.book_set.all()) for record in records[:2]]
+
+        # authors, their books in one query, then the first book
+        self.assertEqual(3, len(context.captured_queries))
+        self.assertEqual([3, 3], counts)
+
+        with self.assertRaises(ValueError):
+            chain.select_related({Chapter:['book']})
+
+# ============================================================================
+
+class ParallelChainTest(TransactionTestCase):
+    def test_parallel(self):
+        seed_people()
+
+        chain = QuerySetChain(User.objects.order_by('id'), 
+            Group.objects.order_by('id'), Author.objects.order_by('id'))
+        parallel = chain.parallel(max_workers=3)
+        self.assertEqual(3, parallel._clone().max_workers)
+
+        # the queries all run in the worker threads, results are in order
+        expected = names(chain[3:12])
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(15, parallel.count())
+            self.assertEqual(expected, names(parallel[3:12]))
+
+        self.assertEqual(0, len(context.captured_queries))
+        self.assertEqual('g2', parallel[7].name)
+
+        merged = QuerySetChain(Author.objects.all(), 
+            Book.objects.all()).order_by('name', 'id')
+        Book.objects.create(name='a2')
+        self.assertEqual(names(merged[:4]), names(merged.parallel()[:4]))
+        self.assertEqual(merged.cursor_page(size=4), 
+            merged.parallel().cursor_page(size=4))
+
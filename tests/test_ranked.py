@@ -1,11 +1,23 @@
+import json
 import re
 
 from django.test import TestCase
 
 from tests.admin import RankAdmin
-from tests.models import Alone, Grouped
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
 
-from awl.waelsteng import AdminToolsMixin
+from unittest import mock
+
+from tests.models import (Alone, Grouped, Filtered, Wide, Team, Player,
+    Optimist, Leader)
+
+from awl.waelsteng import AdminToolsMixin, FakeRequest
+from awl.models import RankVersion
+from awl.rankedmodel.models import RankedModel, RankConflictError
+from awl.rankedmodel.cache import RankCache
+from awl.rankedmodel.signals import ranks_changed
 from awl.utils import refetch
 
 # ============================================================================
@@ -101,6 +113,202 @@ class RankModelBase(TestCase, AdminToolsMixin):
         self.assertEqual(3, d.rank)
         self.assertValues(a.grouped_filter(), 'a,c,d')
 
+    def relative_moves(self):
+        a = self.klass.objects.create(name='a', group='y')
+        b = self.klass.objects.create(name='b', group='y')
+        c = self.klass.objects.create(name='c', group='y')
+        d = self.klass.objects.create(name='d', group='y')
+
+        c.move_to_top()
+        self.assertEqual(1, c.rank)
+        self.assertValues(a.grouped_filter(), 'c,a,b,d')
+
+        # stale in-memory rank for a still moves correctly
+        a.move_to_bottom()
+        self.assertEqual(4, a.rank)
+        self.assertValues(a.grouped_filter(), 'c,b,d,a')
+
+        a.move_above(b)
+        self.assertValues(a.grouped_filter(), 'c,a,b,d')
+        c.move_above(d)
+        self.assertValues(a.grouped_filter(), 'a,b,c,d')
+
+        d.move_below(a)
+        self.assertValues(a.grouped_filter(), 'a,d,b,c')
+        a.move_below(c)
+        self.assertValues(a.grouped_filter(), 'd,b,c,a')
+
+        a.swap(d)
+        self.assertEqual(1, a.rank)
+        self.assertEqual(4, d.rank)
+        self.assertValues(a.grouped_filter(), 'a,b,c,d')
+
+        b.move_to(10)
+        self.assertValues(a.grouped_filter(), 'a,c,d,b')
+        b.move_to(-1)
+        self.assertValues(a.grouped_filter(), 'b,a,c,d')
+        self.assertEqual([1, 2, 3, 4], list(a.grouped_filter().values_list(
+            'rank', flat=True)))
+
+    def admin_queries(self):
+        self.initiate()
+        for name in 'abcde':
+            e = self.klass.objects.create(name=name, group='y')
+
+        rank_admin = RankAdmin(self.klass, self.site)
+        request = FakeRequest(user=self.admin_user)
+        objs = list(rank_admin.get_queryset(request).filter(
+            id__in=e.grouped_filter().values('id')))
+        self.assertEqual([5] * 5, [obj.rank_group_max for obj in objs])
+
+        # warm the content type cache, after which the columns are free
+        self.field_value(rank_admin, objs[0], 'move_both')
+        with CaptureQueriesContext(connection) as context:
+            html = [self.field_value(rank_admin, obj, 'move_both') 
+                for obj in objs]
+            for obj in objs:
+                self.field_value(rank_admin, obj, 'move_up')
+                self.field_value(rank_admin, obj, 'move_down')
+
+        self.assertEqual(0, len(context.captured_queries))
+        self.assertEqual([1, 2, 2, 2, 1], [text.count('rankedmodel/move') 
+            for text in html])
+
+        # URLs are resolved once per content type, not once per row
+        self.field_value(rank_admin, objs[0], 'handle')
+        with mock.patch('awl.rankedmodel.admintools.reverse') as reverse:
+            handles = [self.field_value(rank_admin, obj, 'handle') 
+                for obj in objs]
+
+        reverse.assert_not_called()
+        self.assertEqual(5, len(set(handles)))
+
+        # un-annotated objects still work by counting
+        self.assertEqual('', self.field_value(rank_admin, refetch(objs[-1]),
+            'move_down'))
+
+    def neighbours(self):
+        objs = [self.klass.objects.create(name=name, group='y') 
+            for name in 'abcdefg']
+        a, b, c, d, e, f, g = objs
+
+        self.assertValues(d.neighbours(), 'c,e')
+        self.assertValues(d.neighbours(before=2, after=0), 'b,c')
+        self.assertValues(a.neighbours(before=3, after=2), 'b,c')
+        self.assertValues(g.neighbours(before=1, after=9), 'f')
+
+        self.assertIsNone(a.previous())
+        self.assertEqual(c, d.previous())
+        self.assertEqual(e, d.next())
+        self.assertIsNone(g.next())
+
+        self.assertValues(self.klass.page_around(d, 3), 'c,d,e')
+        self.assertValues(self.klass.page_around(d, 4), 'c,d,e,f')
+        self.assertValues(self.klass.page_around(a, 3), 'a,b,c')
+        self.assertValues(self.klass.page_around(g, 3), 'e,f,g')
+        self.assertValues(self.klass.page_around(b, 10), 'a,b,c,d,e,f,g')
+
+        with CaptureQueriesContext(connection) as context:
+            self.klass.page_around(d, 3)
+
+        self.assertEqual(1, len(context.captured_queries))
+
+    def delete(self):
+        a = self.klass.objects.create(name='a', group='y')
+        b = self.klass.objects.create(name='b', group='y')
+        c = self.klass.objects.create(name='c', group='y')
+        d = self.klass.objects.create(name='d', group='y')
+
+        # single object delete closes the gap
+        b.delete()
+        self.assertEqual(1, refetch(a).rank)
+        self.assertEqual(2, refetch(c).rank)
+        self.assertEqual(3, refetch(d).rank)
+        self.assertValues(a.grouped_filter(), 'a,c,d')
+
+        # queryset delete closes all the gaps
+        e = self.klass.objects.create(name='e', group='y')
+        c.grouped_filter().filter(name__in=['a', 'd']).delete()
+        self.assertEqual(1, refetch(c).rank)
+        self.assertEqual(2, refetch(e).rank)
+        self.assertValues(c.grouped_filter(), 'c,e')
+
+    def stale(self):
+        a = self.klass.objects.create(name='a', group='y')
+        b = self.klass.objects.create(name='b', group='y')
+        c = self.klass.objects.create(name='c', group='y')
+        d = self.klass.objects.create(name='d', group='y')
+
+        # loaded objects go stale when others shift them
+        stale_c = refetch(c)
+        self.klass.objects.create(name='x', rank=1, group='y')
+        stale_c.rank = 1
+        stale_c.save()
+        self.assertValues(a.grouped_filter(), 'c,x,a,b,d')
+        self.assertEqual([1, 2, 3, 4, 5], list(a.grouped_filter().values_list(
+            'rank', flat=True)))
+
+        stale_d = refetch(d)
+        refetch(b).delete()
+        stale_d.delete()
+        self.assertValues(a.grouped_filter(), 'c,x,a')
+        self.assertEqual([1, 2, 3], list(a.grouped_filter().values_list(
+            'rank', flat=True)))
+
+    def signals(self):
+        received = []
+        def receiver(sender, group, values, low, high, **kwargs):
+            received.append((sender, low, high))
+
+        ranks_changed.connect(receiver)
+        self.addCleanup(ranks_changed.disconnect, receiver)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            a = self.klass.objects.create(name='a', group='y')
+            b = self.klass.objects.create(name='b', group='y')
+            c = self.klass.objects.create(name='c', group='y')
+            d = self.klass.objects.create(name='d', group='y')
+
+            # not sent until the transaction commits
+            self.assertEqual([], received)
+
+        self.assertEqual([(self.klass, 1, 1), (self.klass, 2, 2), 
+            (self.klass, 3, 3), (self.klass, 4, 4)], received)
+
+        def sent(action):
+            received.clear()
+            with self.captureOnCommitCallbacks(execute=True):
+                action()
+
+            return [(low, high) for sender, low, high in received]
+
+        self.assertEqual([(1, 4)], sent(d.move_to_top))    # d,a,b,c
+        self.assertEqual([(2, 4)], sent(lambda: a.swap(c)))  # d,c,b,a
+        self.assertEqual([(3, 4)], sent(b.delete))          # d,c,a
+        self.assertEqual([], sent(a.repack))
+        self.assertEqual([(1, 2)], sent(lambda: a.grouped_filter().filter(
+            name='d').delete()))                           # c,a
+
+        def batched():
+            with self.klass.batch():
+                a.move_to(1)
+                c.move_to(1)
+                a.move_to(1)
+
+        self.assertEqual([(1, 2)], sent(batched))           # a,c
+
+        # rolled back changes aren't sent
+        def rolled_back():
+            try:
+                with transaction.atomic():
+                    c.move_to_top()
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        self.assertEqual([], sent(rolled_back))
+        self.assertValues(a.grouped_filter(), 'a,c')
+
     def admin(self):
         self.initiate()
 
@@ -164,6 +372,83 @@ class RankModelBase(TestCase, AdminToolsMixin):
         self.assertValues(c.grouped_filter(), 'c,a,b')
 
 
+    def reorder(self):
+        self.initiate()
+
+        a = self.klass.objects.create(name='a', group='y')
+        b = self.klass.objects.create(name='b', group='y')
+        c = self.klass.objects.create(name='c', group='y')
+        d = self.klass.objects.create(name='d', group='y')
+
+        rank_admin = RankAdmin(self.klass, self.site)
+        html = self.field_value(rank_admin, b, 'handle')
+        url = re.search('data-url="([^"]*)', html).group(1)
+        self.assertIn('data-id="%s"' % b.id, html)
+
+        # rows can only be dropped on rows in the same group
+        group = re.search('data-group="([^"]*)', html).group(1)
+        self.assertIn('data-group="%s"' % group, self.field_value(rank_admin,
+            a, 'handle'))
+        if self.klass.rank_group_fields:
+            other = self.klass.objects.create(name='z', group='z')
+            self.assertNotIn('data-group="%s"' % group, self.field_value(
+                rank_admin, other, 'handle'))
+            other.delete()
+
+        # batch of moves
+        data = {'moves':[{'id':d.id, 'rank':1}, {'id':str(a.id), 'rank':3}]}
+        response = self.authed_post(url, {'data':json.dumps(data)})
+        self.assertValues(a.grouped_filter(), 'd,b,a,c')
+        ranks = response.json()['ranks']
+        self.assertEqual(1, ranks[str(d.id)])
+        self.assertEqual(3, ranks[str(a.id)])
+        self.assertEqual(4, ranks[str(c.id)])
+        self.assertNotIn(str(b.id), ranks)
+
+        # full ordering
+        data = {'order':[c.id, b.id]}
+        response = self.authed_post(url, {'data':json.dumps(data)})
+        self.assertValues(a.grouped_filter(), 'c,b,d,a')
+        self.assertEqual({str(c.id):1, str(d.id):3, str(a.id):4}, 
+            response.json()['ranks'])
+
+        # staff without the change permission can't re-order
+        from django.contrib.auth.models import Permission
+        self.admin_user.is_superuser = False
+        self.admin_user.save()
+        self.authed_post(url, {'data':json.dumps(data)}, response_code=403)
+
+        opts = self.klass._meta
+        self.admin_user.user_permissions.add(Permission.objects.get(
+            content_type__app_label=opts.app_label,
+            codename='change_%s' % opts.model_name))
+        self.authed_post(url, {'data':json.dumps(data)})
+
+        # errors
+        self.authed_post(url, {'data':json.dumps({'foo':1})}, 
+            response_code=400)
+        self.authed_post(url, {'data':json.dumps({'order':[999]})}, 
+            response_code=404)
+        self.authed_get(url, response_code=404)
+
+        from django.contrib.contenttypes.models import ContentType
+        from tests.models import Team
+        content_type = ContentType.objects.get_for_model(Team)
+        bad_url = url.replace('/%s/' % url.split('/')[-2], 
+            '/%s/' % content_type.id)
+        self.authed_post(bad_url, {'data':json.dumps({'order':[]})}, 
+            response_code=404)
+
+        # leaderboard ranks follow their scores and can't be re-ordered
+        from tests.models import Leader
+        content_type = ContentType.objects.get_for_model(Leader)
+        bad_url = url.replace('/%s/' % url.split('/')[-2], 
+            '/%s/' % content_type.id)
+        self.authed_post(bad_url, {'data':json.dumps({'order':[]})}, 
+            response_code=400)
+        self.assertValues(a.grouped_filter(), 'c,b,d,a')
+
+
 class AloneTests(RankModelBase):
     def setUp(self):
         self.klass = Alone
@@ -189,6 +474,27 @@ class AloneTests(RankModelBase):
     def test_repack(self):
         self.repack()
 
+    def test_relative_moves(self):
+        self.relative_moves()
+
+    def test_neighbours(self):
+        self.neighbours()
+
+    def test_admin_queries(self):
+        self.admin_queries()
+
+    def test_reorder(self):
+        self.reorder()
+
+    def test_delete(self):
+        self.delete()
+
+    def test_stale(self):
+        self.stale()
+
+    def test_signals(self):
+        self.signals()
+
     def test_admin(self):
         self.admin()
 
@@ -232,6 +538,678 @@ class GroupedTests(RankModelBase):
         self.repack()
         self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
 
+    def test_relative_moves(self):
+        self.relative_moves()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_neighbours(self):
+        self.neighbours()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_reorder(self):
+        self.reorder()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_admin_queries(self):
+        self.admin_queries()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_relative_moves_other_group(self):
+        a = Grouped.objects.get(group='x', name='a')
+        y = Grouped.objects.create(group='y', name='y')
+        with self.assertRaises(ValueError):
+            a.move_above(y)
+
+    def test_relative_moves_missing(self):
+        # unsaved group changes and deleted rows can't be moved
+        a = Grouped.objects.get(group='x', name='a')
+        a.group = 'y'
+        with self.assertRaises(Grouped.DoesNotExist):
+            a.move_to(2)
+
+        b = Grouped.objects.get(group='x', name='b')
+        c = Grouped.objects.get(group='x', name='c')
+        Grouped.objects.filter(pk=b.pk).delete()
+        with self.assertRaises(Grouped.DoesNotExist):
+            b.move_to_bottom()
+
+        with self.assertRaises(Grouped.DoesNotExist):
+            c.swap(b)
+
+    def test_delete(self):
+        self.delete()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_stale(self):
+        self.stale()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_signals(self):
+        self.signals()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_queryset_delete_groups(self):
+        # delete across both groups, each group is repacked
+        Grouped.objects.create(group='y', name='a')
+        Grouped.objects.create(group='y', name='b')
+        Grouped.objects.create(group='y', name='c')
+        Grouped.objects.filter(name='b').delete()
+
+        self.assertValues(Grouped.objects.filter(group='x'), 'a,c,d')
+        self.assertEqual([1, 2, 3], list(Grouped.objects.filter(
+            group='x').values_list('rank', flat=True)))
+        self.assertValues(Grouped.objects.filter(group='y'), 'a,c')
+        self.assertEqual([1, 2], list(Grouped.objects.filter(
+            group='y').values_list('rank', flat=True)))
+
     def test_admin(self):
         self.admin()
         self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+
+class FilteredTests(RankModelBase):
+    # groups that are only known through an overridden grouped_filter()
+    def setUp(self):
+        self.klass = Filtered
+        Filtered.objects.create(group='x', name='a')
+        Filtered.objects.create(group='x', name='b')
+        Filtered.objects.create(group='x', name='c')
+        Filtered.objects.create(group='x', name='d')
+
+    def test_in_order(self):
+        self.in_order()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_forced_order(self):
+        self.forced_order()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_move(self):
+        self.move()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_relative_moves(self):
+        self.relative_moves()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_delete(self):
+        self.delete()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b,c,d')
+
+    def test_override(self):
+        a = Filtered.objects.get(group='x', name='a')
+        y = Filtered.objects.create(group='y', name='a')
+
+        # the group key is the SQL of grouped_filter()
+        self.assertEqual(str(a.grouped_filter().query), a._group_key())
+        self.assertNotEqual(a._group_key(), y._group_key())
+
+        # nothing to annotate the group's highest rank with
+        qs = Filtered.objects.all()
+        self.assertIs(qs, qs.with_group_max_rank())
+
+        # with no group fields the group's rows are locked
+        with CaptureQueriesContext(connection) as context:
+            a._lock_group()
+
+        self.assertEqual(1, len(context.captured_queries))
+        sql = context.captured_queries[0]['sql']
+        self.assertTrue(sql.startswith(
+            'SELECT "tests_filtered"."id" FROM "tests_filtered"'))
+        self.assertIn('"tests_filtered"."group" = \'x\'', sql)
+
+
+class OptimistTests(RankModelBase):
+    def setUp(self):
+        self.klass = Optimist
+        Optimist.objects.create(group='x', name='a')
+        Optimist.objects.create(group='x', name='b')
+
+    def test_move(self):
+        self.move()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b')
+
+    def test_relative_moves(self):
+        self.relative_moves()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b')
+
+    def test_delete(self):
+        self.delete()
+        self.assertValues(self.klass.objects.filter(group='x'), 'a,b')
+
+    def test_versions(self):
+        # two creates in group "x" bumped its version twice
+        self.assertEqual(1, RankVersion.objects.count())
+        self.assertEqual(2, RankVersion.objects.get().version)
+
+        # conflict on the first attempt is retried
+        b = Optimist.objects.get(group='x', name='b')
+        original = Optimist._swap_versions
+        calls = []
+        def conflicted(obj):
+            calls.append(obj)
+            if len(calls) == 1:
+                # simulate a concurrent writer
+                RankVersion.objects.update(version=100)
+
+            original(obj)
+
+        with mock.patch.object(Optimist, '_swap_versions', conflicted):
+            b.rank = 1
+            b.save()
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, b.rank)
+        # the simulated write was rolled back with the failed attempt
+        self.assertEqual(3, RankVersion.objects.get().version)
+        self.assertValues(self.klass.objects.filter(group='x'), 'b,a')
+
+        # continuous conflicts give up and leave the object as it was
+        def always(obj):
+            RankVersion.objects.update(version=F('version') + 1)
+            original(obj)
+
+        c = Optimist(group='x', name='c', rank=1)
+        with mock.patch.object(Optimist, '_swap_versions', always):
+            with self.assertRaises(RankConflictError):
+                c.save()
+
+        self.assertIsNone(c.pk)
+        self.assertEqual(1, c.rank)
+        self.assertValues(self.klass.objects.filter(group='x'), 'b,a')
+
+
+class WideTests(RankModelBase):
+    def setUp(self):
+        self.klass = Wide
+
+    def test_index(self):
+        # Grouped and Wide declare rank_group_fields and so get a composite
+        # index, Alone does not
+        for klass in (Grouped, Wide):
+            fields = [list(index.fields) for index in klass._meta.indexes]
+            self.assertIn(['group', 'rank'], fields)
+
+        self.assertEqual([], Alone._meta.indexes)
+
+    def test_wide_rank(self):
+        # re-declared rank field replaces the small integer one
+        from django.db.models import PositiveIntegerField
+        field = Wide._meta.get_field('rank')
+        self.assertIs(PositiveIntegerField, field.__class__)
+
+        a = Wide.objects.create(name='a', group='y')
+        Wide.objects.filter(id=a.id).update(rank=40000)
+        self.assertEqual(40000, refetch(a).rank)
+
+    def test_move(self):
+        self.move()
+
+
+class PlayerTests(TestCase):
+    def assertRanks(self, team, expected):
+        names = ','.join(Player.objects.filter(team=team).values_list('name',
+            flat=True))
+        self.assertEqual(expected, names)
+
+    def test_declared_group(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        a = Player.objects.create(team=t1, name='a')
+        b = Player.objects.create(team=t1, name='b')
+        Player.objects.create(team=t2, name='x')
+        c = Player.objects.create(team=t1, name='c', rank=1)
+
+        self.assertEqual((t1.id, ), a._group_key())
+        self.assertEqual(3, a.grouped_filter().count())
+        self.assertRanks(t1, 'c,a,b')
+        self.assertRanks(t2, 'x')
+
+        b = refetch(b)
+        b.rank = 1
+        b.save()
+        self.assertRanks(t1, 'b,c,a')
+
+        c = refetch(c)
+        c.delete()
+        self.assertRanks(t1, 'b,a')
+        self.assertEqual(2, refetch(a).rank)
+        self.assertRanks(t2, 'x')
+
+    def test_queryset_delete(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        Player.objects.create(team=t1, name='a')
+        Player.objects.create(team=t1, name='b')
+        Player.objects.create(team=t2, name='x')
+        Player.objects.create(team=t2, name='y')
+
+        # only the rank and group columns of the deleted rows are read
+        with CaptureQueriesContext(connection) as context:
+            Player.objects.select_related('team').filter(name__in=['a',
+                'x']).delete()
+
+        sqls = [query['sql'] for query in context.captured_queries]
+        selects = [sql for sql in sqls if sql.startswith('SELECT')]
+        select = selects[0].split(' FROM ')[0]
+        self.assertIn('"rank"', select)
+        self.assertIn('"team_id"', select)
+        self.assertNotIn('"name"', select)
+
+        # both teams are locked, in key order, before any row is deleted
+        locks = [index for index, sql in enumerate(sqls) if 
+            '"tests_team"' in sql]
+        deleted = [index for index, sql in enumerate(sqls) if 
+            sql.startswith('DELETE')]
+        self.assertLess(locks[1], deleted[0])
+        self.assertIn('= %s' % t1.id, sqls[locks[0]])
+        self.assertIn('= %s' % t2.id, sqls[locks[1]])
+
+        self.assertRanks(t1, 'b')
+        self.assertRanks(t2, 'y')
+        self.assertEqual([1, 1], list(Player.objects.values_list('rank',
+            flat=True)))
+
+    def test_group_change(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        a = Player.objects.create(team=t1, name='a')
+        b = Player.objects.create(team=t1, name='b')
+        c = Player.objects.create(team=t1, name='c')
+        Player.objects.create(team=t2, name='x')
+        Player.objects.create(team=t2, name='y')
+
+        # unchanged rank moves to the end of the new group
+        b.team = t2
+        b.save()
+        self.assertEqual(3, b.rank)
+        self.assertRanks(t1, 'a,c')
+        self.assertEqual(2, refetch(c).rank)
+        self.assertRanks(t2, 'x,y,b')
+
+        # specific rank is inserted into the new group
+        a = refetch(a)
+        a.team = t2
+        a.rank = 2
+        a.save()
+        self.assertRanks(t1, 'c')
+        self.assertEqual(1, refetch(c).rank)
+        self.assertRanks(t2, 'x,a,y,b')
+        self.assertEqual([1, 2, 3, 4], list(Player.objects.filter(
+            team=t2).values_list('rank', flat=True)))
+
+        # deferred group values can't be compared, nothing is broken
+        c = Player.objects.only('name', 'rank').get(id=c.id)
+        c.name = 'z'
+        c.save()
+        self.assertRanks(t1, 'z')
+
+    def test_group_change_stale(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        Player.objects.create(team=t1, name='a')
+        b = Player.objects.create(team=t1, name='b')
+        Player.objects.create(team=t2, name='x')
+        Player.objects.create(team=t2, name='y')
+
+        # b is shifted after loading, changing only its team still moves it
+        # to the end of the new group
+        stale_b = refetch(b)
+        Player.objects.create(team=t1, name='c', rank=1)
+        stale_b.team = t2
+        stale_b.save()
+        self.assertEqual(3, stale_b.rank)
+        self.assertRanks(t1, 'c,a')
+        self.assertRanks(t2, 'x,y,b')
+        self.assertEqual([1, 2, 3], list(Player.objects.filter(
+            team=t2).values_list('rank', flat=True)))
+
+    def test_group_value_types(self):
+        t1 = Team.objects.create(name='1')
+        Player.objects.create(team=t1, name='a')
+        b = Player.objects.create(team=t1, name='b')
+
+        # the same group given as a string is not a group change
+        b.team_id = str(t1.id)
+        self.assertEqual(refetch(b)._group_key(), b._group_key())
+        self.assertFalse(b._group_changed())
+        b.rank = 1
+        b.save()
+        self.assertRanks(t1, 'b,a')
+        self.assertEqual([1, 2], list(Player.objects.filter(
+            team=t1).values_list('rank', flat=True)))
+
+    def test_group_change_signals(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        a = Player.objects.create(team=t1, name='a')
+        Player.objects.create(team=t1, name='b')
+        Player.objects.create(team=t2, name='x')
+
+        received = []
+        def receiver(sender, group, values, low, high, **kwargs):
+            received.append((group, values, low, high))
+
+        ranks_changed.connect(receiver, sender=Player)
+        self.addCleanup(ranks_changed.disconnect, receiver, sender=Player)
+
+        # rank is unchanged so a is added to the end of t2
+        with self.captureOnCommitCallbacks(execute=True):
+            a.team = t2
+            a.save()
+
+        self.assertEqual([
+            ((t1.id, ), {'team_id':t1.id}, 1, 2),
+            ((t2.id, ), {'team_id':t2.id}, 2, 2),
+        ], received)
+
+    def test_batch(self):
+        t1 = Team.objects.create(name='1')
+        t2 = Team.objects.create(name='2')
+        a = Player.objects.create(team=t1, name='a')
+        b = Player.objects.create(team=t1, name='b')
+        c = Player.objects.create(team=t1, name='c')
+        x = Player.objects.create(team=t2, name='x')
+
+        with Player.batch():
+            # nested batch joins the outer one
+            with Player.batch():
+                c.rank = 1
+                c.save()
+
+            # nothing has been re-ranked yet
+            self.assertEqual(3, refetch(c).rank)
+
+            d = Player.objects.create(team=t1, name='d', rank=2)
+            e = Player.objects.create(team=t1, name='e')
+            b.delete()
+            x.team = t1
+            x.rank = 2
+            x.save()
+            a.name = 'A'
+            a.save()
+
+        self.assertRanks(t1, 'c,x,d,A,e')
+        self.assertEqual([1, 2, 3, 4, 5], list(Player.objects.filter(
+            team=t1).values_list('rank', flat=True)))
+        self.assertRanks(t2, '')
+
+        # in-memory objects have their final ranks
+        self.assertEqual(1, c.rank)
+        self.assertEqual(2, x.rank)
+        self.assertEqual(3, d.rank)
+        self.assertEqual(5, e.rank)
+
+        # queryset delete in a batch repacks once at the end
+        with RankedModel.batch():
+            Player.objects.filter(name__in=['c', 'A']).delete()
+            self.assertEqual(5, refetch(e).rank)
+
+        self.assertRanks(t1, 'x,d,e')
+        self.assertEqual(3, refetch(e).rank)
+
+        # exceptions abandon the batch
+        with self.assertRaises(KeyError):
+            with Player.batch():
+                e.rank = 1
+                e.save()
+                raise KeyError()
+
+        self.assertRanks(t1, 'x,d,e')
+
+        # saving a new object again keeps its placeholder rank until the end
+        with Player.batch():
+            f = Player(team=t1, name='f')
+            f.save()
+            f.name = 'F'
+            f.save()
+            g = Player.objects.create(team=t1, name='g', rank=1)
+            f.rank = 1
+            f.save()
+            f.team = t2
+            f.save()
+
+        self.assertRanks(t1, 'g,x,d,e')
+        self.assertRanks(t2, 'F')
+        self.assertEqual(1, f.rank)
+        self.assertEqual(1, g.rank)
+
+        # relative moves are applied in the order they were made
+        with Player.batch():
+            h = Player.objects.create(team=t1, name='h')
+            g.move_to_bottom()
+            h.move_above(x)
+            e.move_below(refetch(x))
+            x.swap(g)
+            d.move_to_top()
+
+            with self.assertRaises(ValueError):
+                f.swap(x)
+
+        self.assertRanks(t1, 'd,h,g,e,x')
+        self.assertEqual(list(range(1, 6)), list(Player.objects.filter(
+            team=t1).values_list('rank', flat=True)))
+        self.assertEqual(3, g.rank)
+        self.assertEqual(5, x.rank)
+
+        # buffered moves cost no queries until the flush
+        with CaptureQueriesContext(connection) as context:
+            with Player.batch():
+                d.move_to_bottom()
+                d.move_to(1)
+                d.swap(x)
+                d.move_above(g)
+
+        self.assertEqual(1, len([query for query in context.captured_queries
+            if query['sql'].startswith('SAVEPOINT')]))
+        self.assertRanks(t1, 'x,h,d,g,e')
+
+    def test_constant_queries(self):
+        # moving an item costs the same number of queries regardless of the
+        # size of the group
+        def move_cost(size):
+            team = Team.objects.create(name='t')
+            for count in range(size):
+                Player.objects.create(team=team, name='p')
+
+            player = Player.objects.get(team=team, rank=size)
+            player.rank = 1
+            with CaptureQueriesContext(connection) as context:
+                player.save()
+
+            return len(context.captured_queries)
+
+        self.assertEqual(move_cost(3), move_cost(20))
+
+        # same for relative moves
+        def relative_cost(size):
+            team = Team.objects.create(name='t')
+            for count in range(size):
+                Player.objects.create(team=team, name='p')
+
+            first = Player.objects.get(team=team, rank=1)
+            last = Player.objects.get(team=team, rank=size)
+            with CaptureQueriesContext(connection) as context:
+                first.move_to_bottom()
+                first.move_above(last)
+                last.swap(first)
+
+            return len(context.captured_queries)
+
+        self.assertEqual(relative_cost(3), relative_cost(20))
+
+
+class LeaderTests(TestCase):
+    def assertBoard(self, group, expected):
+        names = ','.join(Leader.objects.filter(group=group).values_list(
+            'name', flat=True))
+        self.assertEqual(expected, names)
+        ranks = list(Leader.objects.filter(group=group).values_list('rank',
+            flat=True))
+        self.assertEqual(list(range(1, len(ranks) + 1)), ranks)
+
+    def test_index(self):
+        fields = [list(index.fields) for index in Leader._meta.indexes]
+        self.assertIn(['group', 'rank'], fields)
+        self.assertIn(['group', '-points'], fields)
+
+    def test_scores(self):
+        a = Leader.objects.create(group='y', name='a', points=10)
+        b = Leader.objects.create(group='y', name='b', points=30)
+        c = Leader.objects.create(group='y', name='c', points=20, rank=3)
+        Leader.objects.create(group='x', name='x', points=5)
+        self.assertBoard('y', 'b,c,a')
+        self.assertEqual(2, c.rank)
+
+        # ties go after the existing score
+        d = Leader.objects.create(group='y', name='d', points=20)
+        self.assertBoard('y', 'b,c,d,a')
+
+        # score changes move in both directions
+        a.points = 25
+        a.save()
+        self.assertEqual(2, a.rank)
+        self.assertBoard('y', 'b,a,c,d')
+
+        b.points = 0
+        b.save()
+        self.assertBoard('y', 'a,c,d,b')
+
+        # manual rank is ignored
+        b = refetch(b)
+        b.rank = 1
+        b.save()
+        self.assertBoard('y', 'a,c,d,b')
+
+        # group change
+        d = refetch(d)
+        d.group = 'x'
+        d.save()
+        self.assertBoard('y', 'a,c,b')
+        self.assertBoard('x', 'd,x')
+
+        # delete
+        refetch(c).delete()
+        self.assertBoard('y', 'a,b')
+
+        with self.assertRaises(TypeError):
+            a.move_to_top()
+
+    def test_repack(self):
+        a = Leader.objects.create(group='y', name='a', points=10)
+        b = Leader.objects.create(group='y', name='b', points=30)
+        c = Leader.objects.create(group='y', name='c', points=20)
+        Leader.objects.create(group='x', name='x', points=5)
+
+        # repacking follows the scores rather than the stored ranks
+        Leader.objects.filter(pk=a.pk).update(rank=1)
+        Leader.objects.filter(pk=b.pk).update(rank=5)
+        refetch(a).repack()
+        self.assertBoard('y', 'b,c,a')
+        self.assertBoard('x', 'x')
+
+    def test_batch(self):
+        a = Leader.objects.create(group='y', name='a', points=10)
+        b = Leader.objects.create(group='y', name='b', points=20)
+
+        with Leader.batch():
+            a.points = 30
+            a.save()
+            c = Leader.objects.create(group='y', name='c', points=15)
+
+        self.assertBoard('y', 'a,b,c')
+        self.assertEqual(1, a.rank)
+        self.assertEqual(3, c.rank)
+        self.assertEqual(2, refetch(b).rank)
+
+
+class RankCacheTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        self.rank_cache = RankCache(Grouped, 
+            render=lambda obj: '<li>%s</li>' % obj.name)
+        self.addCleanup(self.rank_cache.disconnect)
+
+        for name in 'abcd':
+            Grouped.objects.create(group='x', name=name)
+            Grouped.objects.create(group='y', name=name)
+
+    def names(self, objs):
+        return ','.join(obj.name for obj in objs)
+
+    def test_slices(self):
+        x = list(Grouped.objects.filter(group='x').order_by('rank'))
+        self.assertEqual([obj.id for obj in x], self.rank_cache.ids(
+            group='x'))
+
+        # ids are served from the cache, the objects in one lookup
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual([obj.id for obj in x], self.rank_cache.ids(
+                obj=x[0]))
+            self.assertEqual('b,c', self.names(self.rank_cache.slice(1, 3,
+                group='x')))
+
+        self.assertEqual(1, len(context.captured_queries))
+
+        self.assertEqual(['<li>a</li>', '<li>b</li>'], self.rank_cache.rows(
+            0, 2, group='x'))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(['<li>b</li>', '<li>c</li>'], 
+                self.rank_cache.rows(1, 3, group='x'))
+
+        # only c needed rendering
+        self.assertEqual(1, len(context.captured_queries))
+
+        with self.assertRaises(TypeError):
+            RankCache(Grouped).rows(0, 1, group='x')
+
+    def test_invalidation(self):
+        a, b, c, d = Grouped.objects.filter(group='x').order_by('rank')
+        self.rank_cache.ids(group='x')
+        self.rank_cache.ids(group='y')
+        self.rank_cache.rows(0, 4, group='x')
+
+        def cached(group):
+            with CaptureQueriesContext(connection) as context:
+                self.rank_cache.ids(group=group)
+
+            return len(context.captured_queries) == 0
+
+        # rank changes invalidate the changed group only
+        with self.captureOnCommitCallbacks(execute=True):
+            d.move_to_top()
+
+        self.assertFalse(cached('x'))
+        self.assertTrue(cached('y'))
+        self.assertEqual('d,a,b,c', self.names(self.rank_cache.slice(0, 4, 
+            group='x')))
+
+        # nothing happens until the change commits
+        with self.captureOnCommitCallbacks(execute=False):
+            c.delete()
+            self.assertTrue(cached('x'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            b.delete()
+
+        self.assertEqual('d,a', self.names(self.rank_cache.slice(0, 4, 
+            group='x')))
+
+        # saves without a rank change still invalidate the rendered rows
+        a = refetch(a)
+        with self.captureOnCommitCallbacks(execute=True):
+            a.name = 'z'
+            a.save()
+
+        self.assertEqual(['<li>d</li>', '<li>z</li>'], self.rank_cache.rows(
+            0, 4, group='x'))
+
+        # explicit invalidation after an update()
+        Grouped.objects.filter(group='y', name='a').update(rank=9)
+        self.assertTrue(cached('y'))
+        self.rank_cache.invalidate(group='y')
+        self.assertEqual('b,c,d,a', self.names(self.rank_cache.slice(0, 4, 
+            group='y')))
+
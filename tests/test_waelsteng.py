@@ -157,6 +157,8 @@ class WRunnerTest(TestCase):
             'test_same_order',
             'test_same_order',
             'test_too_large',
+            'test_audit_ranks',
+            'test_audit_ranks_scores',
             'test_create_admin',
             'test_create_cmd',
             'test_run_script',